@@ -1,6 +1,7 @@
 """Command line options data."""
 
 import argparse
+import types
 
 # Copyright 2002-2025 Michael C. Martin and additional contributors.
 # You may use, modify, and distribute this file under the MIT
@@ -18,6 +19,12 @@ print_loaded_files = False
 print_pass = False
 print_ir = False
 print_labels = False
+profile_passes = False
+
+include_dirs = []
+parse_cache = True
+parse_cache_dir = None
+jobs = 1
 
 infiles = None
 outfile = None
@@ -31,7 +38,8 @@ def parse_args(args):
     global enable_undoc_ops, enable_65c02_exts, enable_4502_exts
     global warn_on_branch_extend
     global print_summary, print_loaded_files
-    global print_pass, print_ir, print_labels
+    global print_pass, print_ir, print_labels, profile_passes
+    global include_dirs, parse_cache, parse_cache_dir, jobs
     global infiles, outfile, listfile, mapfile
 
     program_description = "Ophis 6502 series cross-assembler"
@@ -96,6 +104,12 @@ def parse_args(args):
         default=True,
         help="Do not print warnings",
     )
+    outgrp.add_argument(
+        "--profile-passes",
+        action="store_true",
+        default=False,
+        help="Print the time spent in each assembler pass",
+    )
 
     bingrp = parser.add_argument_group("Compilation options")
     bingrp.add_argument(
@@ -105,6 +119,34 @@ def parse_args(args):
         default="True",
         help="Disable branch-extension pass",
     )
+    bingrp.add_argument(
+        "-I",
+        action="append",
+        default=[],
+        dest="include_dirs",
+        metavar="DIR",
+        help="Search DIR for included source and binary files",
+    )
+    bingrp.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Parse input files in N worker processes",
+    )
+    bingrp.add_argument(
+        "--no-parse-cache",
+        action="store_false",
+        dest="parse_cache",
+        default=True,
+        help="Do not read or write the parse cache",
+    )
+    bingrp.add_argument(
+        "--parse-cache-dir",
+        metavar="DIR",
+        help="Directory for the parse cache (default: ~/.cache/ophis)",
+    )
 
     options = parser.parse_args(args)
 
@@ -117,8 +159,36 @@ def parse_args(args):
     enable_65c02_exts = options.c02
     enable_4502_exts = options.csg4502
     warn_on_branch_extend = options.warn
+    include_dirs = options.include_dirs
+    parse_cache = options.parse_cache
+    parse_cache_dir = options.parse_cache_dir
+    jobs = options.jobs
     print_summary = options.verbose > 0  # no options set
     print_loaded_files = options.verbose > 1  # v
     print_pass = options.verbose > 2  # dd
     print_ir = options.verbose > 3  # ddd
     print_labels = options.verbose > 4  # dddd
+    profile_passes = options.profile_passes
+
+
+def chipset():
+    "Returns the name of the chip whose instruction set is enabled."
+    if enable_undoc_ops:
+        return "6510"
+    elif enable_65c02_exts:
+        return "65c02"
+    elif enable_4502_exts:
+        return "4502"
+    return "6502"
+
+
+def snapshot():
+    "Returns the current settings, for handing to a worker process."
+    return dict((name, value) for (name, value) in globals().items()
+                if not name.startswith("_") and not callable(value) and
+                not isinstance(value, types.ModuleType))
+
+
+def restore(settings):
+    "Adopts settings returned by snapshot."
+    globals().update(settings)
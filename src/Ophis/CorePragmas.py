@@ -10,8 +10,9 @@ import Ophis.CmdLine
 import Ophis.IR as IR
 import Ophis.Frontend as FE
 import Ophis.Errors as Err
+import Ophis.Files as Files
 import math
-import os.path
+import sys
 
 basecharmap = "".join([chr(x) for x in range(256)])
 currentcharmap = basecharmap
@@ -23,94 +24,100 @@ def reset():
     currentcharmap = basecharmap
 
 
+def parse_state():
+    "The character map affects how data directives parse."
+    return currentcharmap
+
+
+def set_parse_state(state):
+    global currentcharmap
+    currentcharmap = state
+
+
 def pragmaOutfile(ppt, line, result):
     "Sets the output file if it hasn't already been set"
-    filename = line.expect("STRING").value
-    line.expect("EOL")
+    filename = line.expect(FE.STRING).value
+    line.expect(FE.EOL)
+    FE.cacheable = False
     if type(filename) == str and Ophis.CmdLine.outfile is None:
         Ophis.CmdLine.outfile = filename
 
 
 def pragmaListfile(ppt, line, result):
     "Sets the listing file if it hasn't already been set"
-    filename = line.expect("STRING").value
-    line.expect("EOL")
+    filename = line.expect(FE.STRING).value
+    line.expect(FE.EOL)
+    FE.cacheable = False
     if type(filename) == str and Ophis.CmdLine.listfile is None:
         Ophis.CmdLine.listfile = filename
 
 
 def pragmaInclude(ppt, line, result):
     "Includes a source file"
-    filename = line.expect("STRING").value
-    line.expect("EOL")
+    filename = line.expect(FE.STRING).value
+    line.expect(FE.EOL)
     if type(filename) == str:
         result.append(FE.parse_file(ppt, filename))
 
 
 def pragmaRequire(ppt, line, result):
     "Includes a source file at most one time"
-    filename = line.expect("STRING").value
-    line.expect("EOL")
+    filename = line.expect(FE.STRING).value
+    line.expect(FE.EOL)
     if type(filename) == str:
         result.append(FE.parse_file(ppt, filename, True))
 
 
 def pragmaIncbin(ppt, line, result):
     "Includes a binary file"
-    filename = line.expect("STRING").value
+    filename = line.expect(FE.STRING).value
     offset = IR.ConstantExpr(0)
     size = None
-    if str(line.lookahead(0)) == ",":
+    if line.lookahead(0).kind == FE.COMMA:
         line.pop()
         offset = FE.parse_expr(line)
-        if str(line.lookahead(0)) == ",":
+        if line.lookahead(0).kind == FE.COMMA:
             line.pop()
             size = FE.parse_expr(line)
-    line.expect("EOL")
+    line.expect(FE.EOL)
+    FE.cacheable = False
     if type(filename) == str:
         try:
-            f = open(os.path.join(FE.context_directory, filename), "rb")
-            if offset.hardcoded and (size is None or size.hardcoded):
-                # We know how big it will be, we can just use the values.
-                # First check to make sure they're sane
-                if offset.value() < 0:
-                    Err.log("Offset may not be negative")
-                    f.close()
-                    return
-                f.seek(0, 2)  # Seek to end of file
-                if offset.value() > f.tell():
-                    Err.log("Offset runs past end of file")
-                    f.close()
-                    return
-                if size is not None:
-                    if size.value() < 0:
-                        Err.log("Length may not be negative")
-                        f.close()
+            path = FE.resolve(filename)
+            with Files.mapped(path) as f:
+                if offset.hardcoded and (size is None or size.hardcoded):
+                    # We know how big it will be, we can just use the
+                    # values, and only the slice we want is ever read.
+                    # First check to make sure they're sane
+                    if offset.value() < 0:
+                        Err.log("Offset may not be negative")
                         return
-                    if offset.value() + size.value() > f.tell():
-                        Err.log(".incbin length too long")
-                        f.close()
+                    if offset.value() > len(f):
+                        Err.log("Offset runs past end of file")
                         return
-                if size is None:
-                    size = IR.ConstantExpr(-1)
-                f.seek(offset.value())
-                bytes = f.read(size.value())
-                bytes = [IR.ConstantExpr(x) for x in bytes]
-                result.append(IR.Node(ppt, "Byte", *bytes))
-            else:
-                # offset or length could change based on label placement.
-                # This seems like an unbelievably bad idea, but since we
-                # don't have constant prop it will happen for any symbolic
-                # alias. Don't use symbolic aliases when extracting tiny
-                # pieces out of humongous files, I guess.
-                bytes = f.read()
-                bytes = [IR.ConstantExpr(x) for x in bytes]
-                if size is None:
-                    size = IR.SequenceExpr([IR.ConstantExpr(len(bytes)),
-                                            "-",
-                                            offset])
-                result.append(IR.Node(ppt, "ByteRange", offset, size, *bytes))
-            f.close()
+                    if size is not None:
+                        if size.value() < 0:
+                            Err.log("Length may not be negative")
+                            return
+                        if offset.value() + size.value() > len(f):
+                            Err.log(".incbin length too long")
+                            return
+                        end = offset.value() + size.value()
+                    else:
+                        end = len(f)
+                    result.append(IR.Node(ppt, "Blob",
+                                          f[offset.value():end]))
+                else:
+                    # offset or length could change based on label
+                    # placement, so the slice is read only once they
+                    # are known, at assembly time.
+                    contents = Files.LazyFile(path, len(f))
+                    if size is None:
+                        size = IR.SequenceExpr([IR.ConstantExpr(len(f)),
+                                                "-",
+                                                offset])
+                    result.append(IR.Node(ppt, "ByteRange", offset, size,
+                                          contents))
         except IOError:
             Err.log("Could not read " + filename)
             return
@@ -119,7 +126,7 @@ def pragmaIncbin(ppt, line, result):
 def pragmaCharmap(ppt, line, result):
     "Modify the character map."
     global currentcharmap, basecharmap
-    if str(line.lookahead(0)) == "EOL":
+    if line.lookahead(0).kind == FE.EOL:
         currentcharmap = basecharmap
     else:
         bytes = readRawData(line)
@@ -138,13 +145,14 @@ def pragmaCharmap(ppt, line, result):
 def pragmaCharmapbin(ppt, line, result):
     "Load a new character map from a file"
     global currentcharmap
-    filename = line.expect("STRING").value
-    line.expect("EOL")
+    filename = line.expect(FE.STRING).value
+    line.expect(FE.EOL)
+    FE.cacheable = False
     if type(filename) == str:
         try:
-            f = open(os.path.join(FE.context_directory, filename), "rb")
-            bytes = f.read()
-            f.close()
+            with Files.mapped(FE.resolve(filename)) as f:
+                # Only a map of the right size is worth reading.
+                bytes = f[:257]
         except IOError:
             Err.log("Could not read " + filename)
             return
@@ -157,41 +165,41 @@ def pragmaCharmapbin(ppt, line, result):
 def pragmaOrg(ppt, line, result):
     "Relocates the PC with no output"
     newPC = FE.parse_expr(line)
-    line.expect("EOL")
+    line.expect(FE.EOL)
     result.append(IR.Node(ppt, "SetPC", newPC))
 
 
 def pragmaAdvance(ppt, line, result):
     "Outputs filler until reaching the target PC"
     newPC = FE.parse_expr(line)
-    if str(line.lookahead(0)) == ",":
+    if line.lookahead(0).kind == FE.COMMA:
         line.pop()
         fillexpr = FE.parse_expr(line)
     else:
         fillexpr = IR.ConstantExpr(0)
-    line.expect("EOL")
+    line.expect(FE.EOL)
     result.append(IR.Node(ppt, "Advance", newPC, fillexpr))
 
 
 def pragmaCheckpc(ppt, line, result):
     "Enforces that the PC has not exceeded a certain point"
     target = FE.parse_expr(line)
-    line.expect("EOL")
+    line.expect(FE.EOL)
     result.append(IR.Node(ppt, "CheckPC", target))
 
 
 def pragmaAlias(ppt, line, result):
     "Assigns an arbitrary label"
-    lbl = line.expect("LABEL").value
+    lbl = line.expect(FE.LABEL).value
     target = FE.parse_expr(line)
     result.append(IR.Node(ppt, "Label", lbl, target))
 
 
 def pragmaSpace(ppt, line, result):
     "Reserves space in a data segment for a variable"
-    lbl = line.expect("LABEL").value
-    size = line.expect("NUM").value
-    line.expect("EOL")
+    lbl = line.expect(FE.LABEL).value
+    size = line.expect(FE.NUM).value
+    line.expect(FE.EOL)
     result.append(IR.Node(ppt, "Label", lbl, IR.PCExpr()))
     result.append(IR.Node(ppt, "SetPC",
                           IR.SequenceExpr([IR.PCExpr(), "+",
@@ -200,9 +208,9 @@ def pragmaSpace(ppt, line, result):
 
 def pragmaText(ppt, line, result):
     "Switches to a text segment"
-    next = line.expect("LABEL", "EOL")
-    if next.type == "LABEL":
-        line.expect("EOL")
+    next = line.expect(FE.LABEL, FE.EOL)
+    if next.kind == FE.LABEL:
+        line.expect(FE.EOL)
         segment = next.value
     else:
         segment = "*text-default*"
@@ -211,9 +219,9 @@ def pragmaText(ppt, line, result):
 
 def pragmaData(ppt, line, result):
     "Switches to a data segment (no output allowed)"
-    next = line.expect("LABEL", "EOL")
-    if next.type == "LABEL":
-        line.expect("EOL")
+    next = line.expect(FE.LABEL, FE.EOL)
+    if next.kind == FE.LABEL:
+        line.expect(FE.EOL)
         segment = next.value
     else:
         segment = "*data-default*"
@@ -225,7 +233,7 @@ def pragmaCbmfloat(ppt, line, result):
     data = []
     while True:
         try:
-            v_str = line.expect("STRING").value
+            v_str = line.expect(FE.STRING).value
             v = float(v_str)
             if v == 0.0:
                 data.extend([0,0,0,0,0])
@@ -247,53 +255,68 @@ def pragmaCbmfloat(ppt, line, result):
                     Err.log("Floating point constant out of range")
         except ValueError:
             Err.log("Expected: floating point")
-        next = line.expect(',', 'EOL').type
-        if next == 'EOL':
+        next = line.expect(FE.COMMA, FE.EOL).kind
+        if next == FE.EOL:
             break
-    bytes = [IR.ConstantExpr(x) for x in data]
-    result.append(IR.Node(ppt, "Byte", *bytes))
+    result.append(IR.Node(ppt, "Blob", bytes(data)))
 
 
 def readRawData(line):
     "Read raw data from a comma-separated list"
-    if line.lookahead(0).type == "STRING":
+    if line.lookahead(0).kind == FE.STRING:
         data = [IR.ConstantExpr(ord(x))
-                for x in line.expect("STRING").value]
+                for x in line.expect(FE.STRING).value]
     else:
         data = [FE.parse_expr(line)]
-    next = line.expect(',', 'EOL').type
-    while next == ',':
-        if line.lookahead(0).type == "STRING":
+    next = line.expect(FE.COMMA, FE.EOL).kind
+    while next == FE.COMMA:
+        if line.lookahead(0).kind == FE.STRING:
             data.extend([IR.ConstantExpr(ord(x))
-                         for x in line.expect("STRING").value])
+                         for x in line.expect(FE.STRING).value])
         else:
             data.append(FE.parse_expr(line))
-        next = line.expect(',', 'EOL').type
+        next = line.expect(FE.COMMA, FE.EOL).kind
     return data
 
 
+def constantBytes(data):
+    """Returns a list of expressions as a bytes object, if they are all
+    constants that fit in a byte, and None otherwise."""
+    values = []
+    for expr in data:
+        if not isinstance(expr, IR.ConstantExpr) or \
+                not 0 <= expr.data <= 0xFF:
+            return None
+        values.append(expr.data)
+    return bytes(values)
+
+
 def readData(line):
     "Read charmap-translated data from a comma-separated list"
-    if line.lookahead(0).type == "STRING":
+    if line.lookahead(0).kind == FE.STRING:
         data = [IR.ConstantExpr(ord(x))
-                for x in line.expect("STRING").value.translate(currentcharmap)]
+                for x in line.expect(FE.STRING).value.translate(currentcharmap)]
     else:
         data = [FE.parse_expr(line)]
-    next = line.expect(',', 'EOL').type
-    while next == ',':
-        if line.lookahead(0).type == "STRING":
+    next = line.expect(FE.COMMA, FE.EOL).kind
+    while next == FE.COMMA:
+        if line.lookahead(0).kind == FE.STRING:
             data.extend([IR.ConstantExpr(ord(x))
-                         for x in line.expect("STRING").value.translate(currentcharmap)])
+                         for x in line.expect(FE.STRING).value.translate(currentcharmap)])
         else:
             data.append(FE.parse_expr(line))
-        next = line.expect(',', 'EOL').type
+        next = line.expect(FE.COMMA, FE.EOL).kind
     return data
 
 
 def pragmaByte(ppt, line, result):
     "Raw data, a byte at a time"
     bytes = readData(line)
-    result.append(IR.Node(ppt, "Byte", *bytes))
+    blob = constantBytes(bytes)
+    if blob is not None:
+        result.append(IR.Node(ppt, "Blob", blob))
+    else:
+        result.append(IR.Node(ppt, "Byte", *bytes))
 
 
 def pragmaWord(ppt, line, result):
@@ -322,33 +345,36 @@ def pragmaDwordbe(ppt, line, result):
 
 def pragmaScope(ppt, line, result):
     "Create a new lexical scoping block"
-    line.expect("EOL")
+    line.expect(FE.EOL)
     result.append(IR.Node(ppt, "ScopeBegin"))
 
 
 def pragmaScend(ppt, line, result):
     "End the innermost lexical scoping block"
-    line.expect("EOL")
+    line.expect(FE.EOL)
     result.append(IR.Node(ppt, "ScopeEnd"))
 
 
 def pragmaMacro(ppt, line, result):
     "Begin a macro definition"
-    lbl = line.expect("LABEL").value
-    line.expect("EOL")
+    lbl = line.expect(FE.LABEL).value
+    line.expect(FE.EOL)
     result.append(IR.Node(ppt, "MacroBegin", lbl))
 
 
 def pragmaMacend(ppt, line, result):
     "End a macro definition"
-    line.expect("EOL")
+    line.expect(FE.EOL)
     result.append(IR.Node(ppt, "MacroEnd"))
 
 
 def pragmaInvoke(ppt, line, result):
-    macro = line.expect("LABEL").value
-    if line.lookahead(0).type == "EOL":
+    macro = line.expect(FE.LABEL).value
+    if line.lookahead(0).kind == FE.EOL:
         args = []
     else:
         args = readRawData(line)
     result.append(IR.Node(ppt, "MacroInvoke", macro, *args))
+
+
+FE.register_pragmas(sys.modules[__name__])
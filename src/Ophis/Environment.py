@@ -29,6 +29,16 @@ class Environment(object):
             return False
         return item in self.dicts[0]
 
+    def defines(self, labels):
+        "Returns true if every label in the set labels is defined."
+        # Labels in the global dictionary are visible from every scope.
+        if self.stack and labels <= self.dicts[0].keys():
+            return True
+        for label in labels:
+            if label not in self:
+                return False
+        return True
+
     def __getitem__(self, item):
         if item[0] == '_':
             for dict in [self.dicts[i] for i in self.stack]:
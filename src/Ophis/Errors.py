@@ -7,18 +7,41 @@
 # You may use, modify, and distribute this file under the MIT
 # license: See README for details.
 
+import contextlib
 import sys
 
 count = 0
 currentpoint = "<Top Level>"
 
+# The list errors are added to, rather than reported, while they are
+# held; see holding.
+held = None
+
+
+@contextlib.contextmanager
+def holding(errors):
+    """Holds back the errors logged within the with statement: each is
+appended to the list errors, with its program point, instead of being
+reported and counted."""
+    global held
+    outer = held
+    held = errors
+    try:
+        yield errors
+    finally:
+        held = outer
+
 
 def log(err):
     """Reports an error at the current program point, and increases
-the global error count."""
+the global error count.  While errors are held, the error and its
+program point are kept instead, to be logged later."""
     global count
+    if held is not None:
+        held.append((currentpoint, err))
+        return
     count = count + 1
-    print(currentpoint + ": " + err, file=sys.stderr)
+    print(str(currentpoint) + ": " + err, file=sys.stderr)
 
 
 def report():
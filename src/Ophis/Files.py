@@ -0,0 +1,96 @@
+"""Input files
+
+    Memory-mapped access to source and binary input files, so that
+    very large inputs are scanned in place rather than read into
+    memory whole."""
+
+# Copyright 2002-2026 Michael C. Martin and additional contributors.
+# You may use, modify, and distribute this file under the MIT
+# license: See README for details.
+
+import codecs
+import contextlib
+import locale
+import mmap
+import re
+
+# The number of bytes lines decodes at a time.
+chunk_size = 1 << 16
+
+# The line endings text mode recognizes.
+line_ending = re.compile("\r\n|\r|\n")
+
+
+@contextlib.contextmanager
+def mapped(filename):
+    """Opens the named file and provides its contents as a read-only
+    buffer.  This is a memory map where possible; files that cannot be
+    mapped, such as empty files and pipes, are simply read."""
+    with open(filename, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            data = None
+        if data is None:
+            yield f.read()
+        else:
+            try:
+                yield data
+            finally:
+                data.close()
+
+
+def lines(data, encoding=None):
+    """Yields the lines of text in a buffer returned by mapped, one at
+    a time and without their line endings.  As in text mode, any of
+    \\n, \\r\\n, and \\r ends a line, and the text is decoded with the
+    locale's preferred encoding unless another is given.  The buffer
+    is decoded a chunk at a time, before it is split, so that any
+    encoding may be used and the whole file is never held as text."""
+    if encoding is None:
+        encoding = locale.getpreferredencoding(False)
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ""
+    for start in range(0, len(data) + 1, chunk_size):
+        final = start + chunk_size > len(data)
+        text = pending + decoder.decode(data[start:start + chunk_size],
+                                        final)
+        pos = 0
+        for match in line_ending.finditer(text):
+            if not final and match.end() == len(text) and \
+                    match.group() == "\r":
+                # The \n of a \r\n pair may be in the next chunk.
+                break
+            yield text[pos:match.start()]
+            pos = match.end()
+        pending = text[pos:]
+    if pending:
+        yield pending
+
+
+class LazyFile(object):
+    """The contents of a file, read only when sliced.  Only the file's
+    name and size are kept, so a LazyFile is small however large the
+    file may be, and it may be pickled.  Each slice maps the file
+    afresh; if the file's size has changed since, slicing raises
+    IOError."""
+    __slots__ = ("filename", "size")
+
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        with mapped(self.filename) as data:
+            if len(data) != self.size:
+                raise IOError(self.filename + " has changed")
+            return data[index]
+
+    def __str__(self):
+        return self.filename
+
+    def __repr__(self):
+        return "LazyFile(%r, %d)" % (self.filename, self.size)
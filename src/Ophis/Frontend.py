@@ -6,6 +6,13 @@ import Ophis.Errors as Err
 import Ophis.Opcodes as Ops
 import Ophis.IR as IR
 import Ophis.CmdLine as Cmd
+import Ophis.ParseCache as Cache
+import Ophis.Files as Files
+import concurrent.futures
+import contextlib
+import importlib
+import io
+import re
 import sys
 import os
 import os.path
@@ -17,26 +24,52 @@ import os.path
 
 loadedfiles = {}
 templabelcount = 0
+# Files that .require found not yet loaded, in order.
+required = []
+
+
+# Token kinds.  Lexemes carry one of these small integers, which the
+# parser compares directly; kind_names holds the name of each, as used
+# in error messages.
+kind_names = ["NUM", "LABEL", "STRING", "OPCODE", "EOL",
+              "X", "Y", "Z", "SP",
+              "#", ",", "`", "<", ">", "(", ")", ":", ".",
+              "+", "-", "*", "/", "&", "|", "^", "[", "]", "{", "}"]
+(NUM, LABEL, STRING, OPCODE, EOL,
+ X, Y, Z, SP,
+ HASH, COMMA, BACKQUOTE, LESS, GREATER, LPAREN, RPAREN, COLON, DOT,
+ PLUS, MINUS, STAR, SLASH, AMPERSAND, BAR, CARET,
+ LBRACKET, RBRACKET, LBRACE, RBRACE) = range(len(kind_names))
 
 
 class Lexeme(object):
-    "Class for lexer tokens.  Used by lexer and parser."
-    def __init__(self, type="UNKNOWN", value=None):
-        self.type = type.upper()
+    """Class for lexer tokens.  Used by lexer and parser.  Lexemes are
+    never modified once made, so those without a value are shared."""
+    __slots__ = ("kind", "value")
+
+    def __init__(self, kind, value=None):
+        self.kind = kind
         self.value = value
 
     def __str__(self):
         if self.value is None:
-            return self.type
+            return kind_names[self.kind]
         else:
-            return self.type + ":" + str(self.value)
+            return kind_names[self.kind] + ":" + str(self.value)
 
     def __repr__(self):
-        return "Lexeme(" + repr(self.type) + ", " + repr(self.value) + ")"
+        return "Lexeme(" + kind_names[self.kind] + ", " + \
+            repr(self.value) + ")"
 
     def matches(self, other):
-        "1 if Lexemes a and b have the same type."
-        return self.type == other.type
+        "1 if Lexemes a and b have the same kind."
+        return self.kind == other.kind
+
+
+# The shared value-less lexemes, by name.
+bare_lexemes = dict((name, Lexeme(kind))
+                    for (kind, name) in enumerate(kind_names)
+                    if kind >= EOL)
 
 
 bases = {"$": ("hexadecimal", 16),
@@ -47,120 +80,160 @@ bases = {"$": ("hexadecimal", 16),
 punctuation = "#,`<>():.+-*/&|^[]{}"
 
 
-operators = ["&","|","^","+","-","*","/"]
+# The lexer is driven by a single compiled regular expression.  Each
+# match is one of: a run of whitespace, a comment, a punctuation mark,
+# a string constant (plus anything glued onto its closing quote), a
+# word (number, label, opcode, or register), or a backslash with
+# nothing left to escape.  Backslashes escape the following character
+# anywhere on the line, and a '.' continues a word once it has begun.
+_wordchar = r"""(?:[^\s"\\;#,`<>():.+\-*/&|^\[\]{}]|\\.)"""
+_token_re = re.compile(r"""
+      (?P<space>\s+)
+    | (?P<comment>;)
+    | (?P<punct>[#,`<>():.+\-*/&|^\[\]{}])
+    | "(?P<string>(?:[^"\\]|\\.)*)
+       (?:(?P<close>")(?P<tail>(?:%(w)s|\.)*))?
+    | (?P<word>%(w)s(?:%(w)s|\.)*)
+    | (?P<backslash>\\)
+    """ % {"w": _wordchar}, re.VERBOSE | re.DOTALL)
+_escape_re = re.compile(r"\\(.)", re.DOTALL)
+# Lines with no strings or backslashes, which is nearly all of them,
+# can be split up by a single findall.
+_plain_re = re.compile(r"""[#,`<>():.+\-*/&|^\[\]{}]
+                         | [^\s"\\;#,`<>():.+\-*/&|^\[\]{}]
+                           [^\s"\\;#,`<>():+\-*/&|^\[\]{}]*""",
+                       re.VERBOSE)
+
+
+def unescape(text):
+    "Strips the backslashes out of a lexed word or string."
+    if "\\" in text:
+        return _escape_re.sub(r"\1", text)
+    return text
+
+
+def is_opcode(op):
+    "Tests whether a string is an opcode or an identifier"
+    return op in Ops.mnemonics
+
+
+registers = {"x": bare_lexemes["X"], "y": bare_lexemes["Y"],
+             "z": bare_lexemes["Z"], "sp": bare_lexemes["SP"]}
+register_kinds = frozenset([X, Y, Z, SP])
+
+
+def lex_string(token):
+    return Lexeme(STRING, token[1:])
+
+
+def lex_based(token):
+    if token == "0":
+        return Lexeme(NUM, 0)
+    (name, base) = bases[token[0]]
+    try:
+        return Lexeme(NUM, int(token[1:], base))
+    except ValueError:
+        Err.log('Invalid ' + name + ' constant: ' + token[1:])
+        return Lexeme(NUM, 0)
+
+
+def lex_decimal(token):
+    try:
+        return Lexeme(NUM, int(token))
+    except ValueError:
+        Err.log('Identifiers may not begin with a number')
+        return Lexeme(LABEL, "ERROR")
+
+
+def lex_character(token):
+    if len(token) == 2:
+        return Lexeme(NUM, ord(token[1]))
+    Err.log("Invalid character constant '" + token[1:] + "'")
+    return Lexeme(NUM, 0)
+
+
+def lex_punctuation(token):
+    if len(token) != 1:
+        Err.log("Internal lexer error!  '" + token + "' can't happen!")
+    return bare_lexemes[token[0]]
+
+
+def lex_word(token):
+    "Label, opcode, or index register"
+    if token[0].isdigit():
+        # Digits outside of ASCII are still numbers
+        return lex_decimal(token)
+    id = token.lower()
+    if is_opcode(id):
+        return Lexeme(OPCODE, id)
+    elif id in registers:
+        return registers[id]
+    else:
+        return Lexeme(LABEL, id)
+
+
+# Maps the first character of a token to the routine that converts it
+# into a lexeme.  Anything not listed here is a word.
+token_lexers = {'"': lex_string, "'": lex_character}
+token_lexers.update(dict.fromkeys(bases, lex_based))
+token_lexers.update(dict.fromkeys(punctuation, lex_punctuation))
+token_lexers.update(dict.fromkeys("123456789", lex_decimal))
+
+
+def add_token(result, token):
+    "Converts a substring into a single lexeme"
+    if token != "":
+        result.append(token_lexers.get(token[0], lex_word)(token))
+
+
+eol = bare_lexemes["EOL"]
 
 
 def lex(point, line):
     """Turns a line of source into a sequence of lexemes."""
     Err.currentpoint = point
     result = []
-
-    def is_opcode(op):
-        "Tests whether a string is an opcode or an identifier"
-        return op in Ops.opcodes
-
-    def add_token(token):
-        "Converts a substring into a single lexeme"
-        if token == "":
-            return
-        if token == "0":
-            result.append(Lexeme("NUM", 0))
-            return
-        firstchar = token[0]
-        rest = token[1:]
-        if firstchar == '"':
-            result.append(Lexeme("STRING", rest))
-            return
-        elif firstchar in bases:
-            try:
-                result.append(Lexeme("NUM", int(rest, bases[firstchar][1])))
-                return
-            except ValueError:
-                Err.log('Invalid ' + bases[firstchar][0] + ' constant: ' +
-                        rest)
-                result.append(Lexeme("NUM", 0))
-                return
-        elif firstchar.isdigit():
-            try:
-                result.append(Lexeme("NUM", int(token)))
-            except ValueError:
-                Err.log('Identifiers may not begin with a number')
-                result.append(Lexeme("LABEL", "ERROR"))
-            return
-        elif firstchar == "'":
-            if len(rest) == 1:
-                result.append(Lexeme("NUM", ord(rest)))
-            else:
-                Err.log("Invalid character constant '" + rest + "'")
-                result.append(Lexeme("NUM", 0))
-            return
-        elif firstchar in punctuation:
-            if rest != "":
-                Err.log("Internal lexer error!  '" + token + "' can't happen!")
-            result.append(Lexeme(firstchar))
-            return
-        else:   # Label, opcode, or index register
-            id = token.lower()
-            if is_opcode(id):
-                result.append(Lexeme("OPCODE", id))
-            elif id == "x":
-                result.append(Lexeme("X"))
-            elif id == "y":
-                result.append(Lexeme("Y"))
-            elif id == "z":
-                result.append(Lexeme("Z"))
-            elif id == "sp":
-                result.append(Lexeme("SP"))
-            else:
-                result.append(Lexeme("LABEL", id))
-            return
-        # should never reach here
-        Err.log("Internal lexer error: add_token fall-through")
-
-    def add_EOL():
-        "Adds an end-of-line lexeme"
-        result.append(Lexeme("EOL"))
-
-    # Actual routine begins here
-    value = ""
-    quotemode = False
-    backslashmode = False
-    for c in line.strip():
-        if backslashmode:
-            backslashmode = False
-            value = value + c
-        elif c == "\\":
-            backslashmode = True
-        elif quotemode:
-            if c == '"':
-                quotemode = False
-            else:
-                value = value + c
-        elif c == ';':
-            add_token(value)
-            value = ""
+    line = line.strip()
+    if '"' not in line and "\\" not in line:
+        lexers = token_lexers
+        for token in _plain_re.findall(line.split(";", 1)[0]):
+            result.append(lexers.get(token[0], lex_word)(token))
+        result.append(eol)
+        return result
+    # The most recent word or string is held back until we know the
+    # line does not end in a dangling backslash or open string, so
+    # that errors are reported in the same order as always.  A
+    # closed string reports its last group as "tail".
+    pending = None
+    unterminated = False
+    backslashed = False
+    for match in _token_re.finditer(line):
+        kind = match.lastgroup
+        if kind == "backslash":
+            backslashed = True
+            continue
+        if pending is not None:
+            add_token(result, pending)
+            pending = None
+        if kind == "word":
+            pending = unescape(match.group("word"))
+        elif kind == "punct":
+            result.append(bare_lexemes[match.group("punct")])
+        elif kind == "comment":
             break
-        elif c == '.' and value != "":
-            value = value + c
-        elif c.isspace():
-            add_token(value)
-            value = ""
-        elif c in punctuation:
-            add_token(value)
-            add_token(c)
-            value = ""
-        elif c == '"':
-            add_token(value)
-            value = '"'
-            quotemode = True
-        else:
-            value = value + c
-    if backslashmode:
+        elif kind == "tail":
+            pending = '"' + unescape(match.group("string") +
+                                     match.group("tail"))
+        elif kind == "string":
+            unterminated = True
+            pending = '"' + unescape(match.group("string"))
+    if backslashed:
         Err.log("Backslashed newline")
-    if quotemode:
+    if unterminated:
         Err.log("Unterminated string constant")
-    add_token(value)
-    add_EOL()
+    if pending is not None:
+        add_token(result, pending)
+    result.append(eol)
     return result
 
 
@@ -187,123 +260,132 @@ class ParseLine(object):
             self.location += 1
         return self.lexemes[old]
 
-    def expect(self, *tokens):
+    def expect(self, *kinds):
         """Reads a token from the ParseLine line and returns it if it's of a
-    type in the sequence tokens.  Otherwise, it logs an error."""
+    kind in the sequence kinds.  Otherwise, it logs an error.  Registers
+    and opcodes are read as labels where a label is expected."""
         token = self.pop()
-        if token.type in tokens:
+        if token.kind in kinds:
             return token
-        if 'LABEL' in tokens:
-            if token.type in ['X', 'Y', 'Z', 'SP']:
-                token.value = token.type.lower()
-                token.type = 'LABEL'
-                return token
-            elif token.type == 'OPCODE':
-                token.type = 'LABEL'
-                return token
-        Err.log('Expected: "' + '", "'.join(tokens) + '"')
+        if LABEL in kinds:
+            if token.kind in register_kinds:
+                return Lexeme(LABEL, kind_names[token.kind].lower())
+            elif token.kind == OPCODE:
+                return Lexeme(LABEL, token.value)
+        Err.log('Expected: "' + '", "'.join(kind_names[k] for k in kinds) +
+                '"')
         return token
 
 
+# Pragma handlers, keyed by the lowercased pragma name.  A module's
+# handlers are the functions named "pragma" followed by the pragma's
+# name in title case, each called as handler(ppt, line, result).
+pragmas = {}
 pragma_modules = []
 
 
+def register_pragmas(module):
+    """Adds every pragma handler in module to the registry.  Handlers
+    registered later replace earlier ones of the same name, so that
+    extension modules may override core pragmas.  Registering a module
+    a second time does nothing.  The core pragmas are registered
+    first, as soon as this module is loaded."""
+    if module in pragma_modules:
+        return
+    pragma_modules.append(module)
+    for name in dir(module):
+        suffix = name[len("pragma"):]
+        if name.startswith("pragma") and suffix != "" and \
+                suffix.lower().title() == suffix and \
+                callable(getattr(module, name)):
+            pragmas[suffix.lower()] = getattr(module, name)
+
+
+# Binding strength of each binary operator.  All operators are
+# left-associative, and a run of operators that share a level is
+# collected into a single SequenceExpr.
+precedences = {AMPERSAND: 1, BAR: 1, CARET: 1,
+               PLUS: 2, MINUS: 2,
+               STAR: 3, SLASH: 3}
+
+# Matching closers for the grouping operators.
+groupings = {LPAREN: RPAREN, LBRACKET: RBRACKET, LBRACE: RBRACE}
+
+# Tokens that can name a label in an expression.
+label_kinds = frozenset([LABEL, X, Y, Z, SP, OPCODE])
+
+
+def parse_atom(line):
+    "Parses an operand: a number, label, ^, group, or byte selector."
+    next = line.lookahead(0).kind
+    if next == NUM:
+        return IR.ConstantExpr(line.pop().value)
+    elif next in label_kinds:
+        return IR.LabelExpr(line.expect(LABEL).value)
+    elif next == CARET:
+        line.pop()
+        return IR.PCExpr()
+    elif next in groupings:
+        line.pop()
+        result = parse_expr(line)
+        line.expect(groupings[next])
+        return result
+    elif next == PLUS:
+        offset = 0
+        while next == PLUS:
+            offset += 1
+            line.pop()
+            next = line.lookahead(0).kind
+        return IR.LabelExpr("*" + str(templabelcount + offset))
+    elif next == MINUS:
+        offset = 1
+        while next == MINUS:
+            offset -= 1
+            line.pop()
+            next = line.lookahead(0).kind
+        return IR.LabelExpr("*" + str(templabelcount + offset))
+    elif next == GREATER:
+        line.pop()
+        return IR.HighByteExpr(parse_atom(line))
+    elif next == LESS:
+        line.pop()
+        return IR.LowByteExpr(parse_atom(line))
+    else:
+        Err.log('Expected: expression')
+
+
+def parse_operators(line, head, minimum):
+    """Extends the already-parsed operand head with any operators that
+    bind at least as tightly as the level minimum."""
+    op = line.lookahead(0).kind
+    level = precedences.get(op)
+    while level is not None and level >= minimum:
+        result = [head]
+        current = level
+        while level == current:
+            line.pop()
+            operand = parse_atom(line)
+            next = line.lookahead(0).kind
+            level = precedences.get(next)
+            if level is not None and level > current:
+                operand = parse_operators(line, operand, current + 1)
+                next = line.lookahead(0).kind
+                level = precedences.get(next)
+            result.append(kind_names[op])
+            result.append(operand)
+            op = next
+        head = IR.SequenceExpr(result)
+    return head
+
+
 def parse_expr(line, first_atom=None):
     """Parses an Ophis arithmetic expression. If first_atom is not
        None, then it was a parenthesized expression parsed before
        realizing that it did not represent indirection, and parsing
        will proceed from that point."""
-
-    def atom():
-        "Parses lowest-priority expression components."
-        global templabelcount
-        next = line.lookahead(0).type
-        if next == "NUM":
-            return IR.ConstantExpr(line.expect("NUM").value)
-        elif next in ["LABEL", "X", "Y", "Z", "SP", "OPCODE"]:
-            return IR.LabelExpr(line.expect("LABEL").value)
-        elif next == "^":
-            line.expect("^")
-            return IR.PCExpr()
-        elif next == "{":
-            line.expect("{")
-            result = parse_expr(line)
-            line.expect("}")
-            return result
-        elif next == "[":
-            line.expect("[")
-            result = parse_expr(line)
-            line.expect("]")
-            return result
-        elif next == "(":
-            line.expect("(")
-            result = parse_expr(line)
-            line.expect(")")
-            return result
-        elif next == "+":
-            offset = 0
-            while next == "+":
-                offset += 1
-                line.expect("+")
-                next = line.lookahead(0).type
-            return IR.LabelExpr("*" + str(templabelcount + offset))
-        elif next == "-":
-            offset = 1
-            while next == "-":
-                offset -= 1
-                line.expect("-")
-                next = line.lookahead(0).type
-            return IR.LabelExpr("*" + str(templabelcount + offset))
-        elif next == ">":
-            line.expect(">")
-            return IR.HighByteExpr(atom())
-        elif next == "<":
-            line.expect("<")
-            return IR.LowByteExpr(atom())
-        else:
-            Err.log('Expected: expression')
-
-    def precedence_read(constructor, reader, separators, head=None):
-        """Handles precedence.  The reader argument is a function that returns
-    expressions that bind more tightly than these; separators is a list
-    of strings naming the operators at this precedence level.  The
-    constructor argument is a class, indicating what node type holds
-    objects of this precedence level. The optional head argument, if not
-    None, indicates that a parse discovered this was an expression partway
-    through and must now complete the tail.
-
-    Returns a list of Expr objects with separator strings between them."""
-        if head is not None:
-            result = [head] # preassign first object
-        else:
-            result = [reader()]  # read first object
-        nextop = line.lookahead(0).type
-        while (nextop in separators):
-            line.expect(nextop)
-            result.append(nextop)
-            result.append(reader())
-            nextop = line.lookahead(0).type
-        if len(result) == 1:
-            return result[0]
-        return constructor(result)
-
-    def term(h=None):
-        "Parses * and /"
-        return precedence_read(IR.SequenceExpr, atom, ["*", "/"], h)
-
-    def arith(h=None):
-        "Parses + and -"
-        return precedence_read(IR.SequenceExpr, term, ["+", "-"], h)
-
-    def bits(h=None):
-        "Parses &, |, and ^"
-        return precedence_read(IR.SequenceExpr, arith, ["&", "|", "^"], h)
-
     if first_atom is None:
-        return bits()
-    first_term = term(first_atom)
-    first_arith = arith(first_term)
-    return bits(first_arith)
+        first_atom = parse_atom(line)
+    return parse_operators(line, first_atom, 1)
 
 
 def parse_line(ppt, lexemelist):
@@ -314,8 +396,8 @@ def parse_line(ppt, lexemelist):
 
     def parse_memory_tail(opcode):
         arg2 = None
-        tok = line.expect("EOL", ",").type
-        if tok == ",":
+        tok = line.expect(EOL, COMMA).kind
+        if tok == COMMA:
             # Parser has to special-case the BBXn instructions,
             # Which uniquely take two addresses
             if (Cmd.enable_65c02_exts or Cmd.enable_4502_exts) and opcode[:3] in ["bbs", "bbr"]:
@@ -323,99 +405,97 @@ def parse_line(ppt, lexemelist):
                 mode = "Memory2"
             else:
                 if Cmd.enable_4502_exts:
-                    tok = line.expect("X", "Y", "Z").type
+                    tok = line.expect(X, Y, Z).kind
                 else:
-                    tok = line.expect("X", "Y").type
-                if tok == "Z":
+                    tok = line.expect(X, Y).kind
+                if tok == Z:
                     mode = "MemoryZ"
-                elif tok == "Y":
+                elif tok == Y:
                     mode = "MemoryY"
                 else:
                     mode = "MemoryX"
-            line.expect("EOL")
+            line.expect(EOL)
         else:
             mode = "Memory"
         return (mode, arg2)
 
     def aux():
         "Accumulates all IR nodes defined by this line."
-        if line.lookahead(0).type == "EOL":
+        if line.lookahead(0).kind == EOL:
             pass
-        elif line.lookahead(1).type == ":":
-            newlabel = line.expect("LABEL").value
-            line.expect(":")
+        elif line.lookahead(1).kind == COLON:
+            newlabel = line.expect(LABEL).value
+            line.expect(COLON)
             result.append(IR.Node(ppt, "Label", newlabel, IR.PCExpr()))
             aux()
-        elif line.lookahead(0).type == "*" or line.lookahead(0).type == ':':
+        elif line.lookahead(0).kind == STAR or line.lookahead(0).kind == COLON:
             global templabelcount
             templabelcount = templabelcount + 1
             result.append(IR.Node(ppt, "Label", "*" + str(templabelcount),
                                   IR.PCExpr()))
-            line.expect("*", ":")
+            line.expect(STAR, COLON)
             aux()
-        elif line.lookahead(0).type == "." or line.lookahead(0).type == "`":
-            which = line.expect(".", "`").type
-            if (which == "."):
-                pragma = line.expect("LABEL").value
+        elif line.lookahead(0).kind == DOT or line.lookahead(0).kind == BACKQUOTE:
+            which = line.expect(DOT, BACKQUOTE).kind
+            if (which == DOT):
+                pragma = line.expect(LABEL).value
             else:
                 pragma = "invoke"
-            pragmaFunction = "pragma" + pragma.title()
-            for mod in pragma_modules:
-                if hasattr(mod, pragmaFunction):
-                    getattr(mod, pragmaFunction)(ppt, line, result)
-                    break
+            handler = pragmas.get(pragma)
+            if handler is not None:
+                handler(ppt, line, result)
             else:
                 Err.log("Unknown pragma " + pragma)
         else:   # Instruction
-            opcode = line.expect("OPCODE").value
+            opcode = line.expect(OPCODE).value
             arg2 = None
-            if line.lookahead(0).type == "#":
+            if line.lookahead(0).kind == HASH:
                 mode = "Immediate"
-                line.expect("#")
+                line.expect(HASH)
                 arg = parse_expr(line)
-                line.expect("EOL")
-            elif line.lookahead(0).type == "(":
-                line.expect("(")
+                line.expect(EOL)
+            elif line.lookahead(0).kind == LPAREN:
+                line.expect(LPAREN)
                 arg = parse_expr(line)
-                if line.lookahead(0).type == ",":
-                    line.expect(",")
-                    if Cmd.enable_4502_exts and line.lookahead(0).type == "SP":
+                if line.lookahead(0).kind == COMMA:
+                    line.expect(COMMA)
+                    if Cmd.enable_4502_exts and line.lookahead(0).kind == SP:
                         mode = "PointerSPY"
-                        line.expect("SP")
-                        line.expect(")")
-                        line.expect(",")
-                        line.expect("Y")
-                        line.expect("EOL")
+                        line.expect(SP)
+                        line.expect(RPAREN)
+                        line.expect(COMMA)
+                        line.expect(Y)
+                        line.expect(EOL)
                     else:
                         mode = "PointerX"
                         if Cmd.enable_4502_exts:
-                            line.expect("X", "SP")      # SP here for the error
+                            line.expect(X, SP)      # SP here for the error
                         else:
-                            line.expect("X")
-                        line.expect(")")
-                        line.expect("EOL")
+                            line.expect(X)
+                        line.expect(RPAREN)
+                        line.expect(EOL)
                 else:
-                    line.expect(")")
-                    if line.lookahead(0).type in operators:
+                    line.expect(RPAREN)
+                    if line.lookahead(0).kind in precedences:
                         arg = parse_expr(line,arg)
                         (mode, arg2) = parse_memory_tail(opcode)
                     else:
-                        tok = line.expect(",", "EOL").type
-                        if tok == "EOL":
+                        tok = line.expect(COMMA, EOL).kind
+                        if tok == EOL:
                             mode = "Pointer"
                         else:
-                            if Cmd.enable_4502_exts and line.lookahead(0).type == "Z":
+                            if Cmd.enable_4502_exts and line.lookahead(0).kind == Z:
                                 mode = "PointerZ"
-                                line.expect("Z")
-                                line.expect("EOL")
+                                line.expect(Z)
+                                line.expect(EOL)
                             else:
                                 mode = "PointerY"
                                 if Cmd.enable_4502_exts:
-                                    line.expect("Y", "Z")
+                                    line.expect(Y, Z)
                                 else:
-                                    line.expect("Y")
-                                line.expect("EOL")
-            elif line.lookahead(0).type == "EOL":
+                                    line.expect(Y)
+                                line.expect(EOL)
+            elif line.lookahead(0).kind == EOL:
                 mode = "Implied"
                 arg = None
             else:
@@ -434,20 +514,182 @@ def parse_line(ppt, lexemelist):
 
 context_directory = None
 
+# Per-run memos of where each file named in the source was found, and
+# of the os.stat results for every path looked at along the way, so
+# that a .require of a file seen before costs one dictionary lookup.
+# parse() clears them.
+resolved_paths = {}
+path_stats = {}
+
+
+def stat(path):
+    "Returns os.stat(path), or None if there is no such file."
+    if path in path_stats:
+        return path_stats[path]
+    try:
+        result = os.stat(path)
+    except OSError:
+        result = None
+    path_stats[path] = result
+    return result
+
+
+def resolve(filename, directory=None):
+    """Returns the absolute path of a file named by a pragma in the
+    file being parsed, or in a file in the given directory.  The
+    directory of that file is searched first, then each directory
+    given with -I, in order.  A file that is not found anywhere
+    resolves to where it would have been in the first place, for the
+    sake of error messages."""
+    if directory is None:
+        directory = context_directory
+    key = (directory, filename)
+    result = resolved_paths.get(key)
+    if result is None:
+        result = os.path.abspath(os.path.join(directory, filename))
+        if stat(result) is None:
+            for dirname in Cmd.include_dirs:
+                candidate = os.path.abspath(os.path.join(dirname, filename))
+                if stat(candidate) is not None:
+                    result = candidate
+                    break
+        resolved_paths[key] = result
+    return result
+
+# Whether the file currently being parsed may be stored in the parse
+# cache.  Pragmas that read binary files or change settings outside of
+# the IR clear it, since replaying the cached IR would not redo them.
+cacheable = True
+
+# The source files that .include and .require have read, or skipped,
+# while parsing the file that will be stored in the parse cache, or
+# None if there is no such file.  Each is a tuple of the directory and
+# name it was found from, its path, the digest of its contents (None if
+# it was skipped), whether it was required, and whether it was skipped.
+included = None
+
+
+def parse_state():
+    """Returns the state that parsing depends on and changes, apart
+    from the source text itself.  Pragma modules contribute to this
+    with parse_state and set_parse_state functions of their own."""
+    return (templabelcount,
+            tuple(mod.parse_state() for mod in pragma_modules
+                  if hasattr(mod, "parse_state")))
+
+
+def set_parse_state(state):
+    "Restores state saved by parse_state."
+    global templabelcount
+    (templabelcount, modstates) = state
+    mods = [mod for mod in pragma_modules if hasattr(mod, "parse_state")]
+    for (mod, modstate) in zip(mods, modstates):
+        mod.set_parse_state(modstate)
+
+
+def iter_nodes(filename, lines):
+    """Lexes and parses source lines one at a time as they are read
+    from the iterable lines, yielding the IR nodes they produce.  Only
+    the nodes themselves outlive each line."""
+    lineno = 0
+    for line in lines:
+        lineno += 1
+        ppt = IR.ProgramPoint(filename, lineno)
+        node = parse_line(ppt, lex(ppt, line))
+        if node is not IR.NullNode:
+            yield node
+
+
+def still_included(files):
+    """Checks that the files a cached parse read would be read again:
+    that each name still resolves to the same file, with the same
+    contents, and that .require would skip the same files."""
+    loaded = set(loadedfiles)
+    for (directory, name, path, digest, once, skipped) in files:
+        if resolve(name, directory) != path:
+            return False
+        if once and (path in loaded) != skipped:
+            return False
+        if not skipped:
+            if Cache.file_digest(path) != digest:
+                return False
+            loaded.add(path)
+    return True
+
+
+def replay_included(files):
+    "Marks the files a cached parse read as read again."
+    for (directory, name, path, digest, once, skipped) in files:
+        if skipped:
+            if Cmd.print_loaded_files:
+                print("Skipping " + path, file=sys.stderr)
+            continue
+        if once:
+            required.append(path)
+        loadedfiles[path] = True
+        if Cmd.print_loaded_files:
+            print("Loading " + path, file=sys.stderr)
+
+
+def parse_cached(filename, data):
+    """Parses the contents of a source file, as returned by
+    Files.mapped, using or filling the parse cache as appropriate.
+    Returns the IR nodes, or an iterator over them when there is no
+    cache entry to fill."""
+    global cacheable, included
+    key = Cache.key(filename, data,
+                    (Cmd.enable_undoc_ops, Cmd.enable_65c02_exts,
+                     Cmd.enable_4502_exts, parse_state()),
+                    pragma_modules)
+    if key is None:
+        return iter_nodes(filename, Files.lines(data))
+    hit = Cache.load(key)
+    if hit is not None and still_included(hit[2]):
+        (state, IRlist, files) = hit
+        set_parse_state(state)
+        replay_included(files)
+        if included is not None:
+            included.extend(files)
+        return IRlist
+    # Whatever includes this file is cached with it only if it is.
+    outer = (cacheable, included)
+    errors = Err.count
+    cacheable = True
+    included = []
+    try:
+        IRlist = list(iter_nodes(filename, Files.lines(data)))
+        if cacheable and Err.count == errors:
+            Cache.store(key, parse_state(), IRlist, included)
+    finally:
+        (outer_cacheable, outer_included) = outer
+        if outer_included is not None:
+            outer_included.extend(included)
+        cacheable = outer_cacheable and cacheable
+        included = outer_included
+    return IRlist
+
 
 def parse_file(ppt, filename, load_once=False):
     "Loads an Ophis source file, and returns an IR list."
-    global context_directory, loadedfiles
+    global context_directory, loadedfiles, cacheable
     Err.currentpoint = ppt
     old_context = context_directory
-    if filename != '-':
+    name = filename
+    if filename == '-':
+        # Standard input can't be checked for changes.
+        cacheable = False
+    else:
         if context_directory is not None:
-            filename = os.path.abspath(os.path.join(context_directory,
-                                                    filename))
+            filename = resolve(filename)
         if load_once and filename in loadedfiles:
             if Cmd.print_loaded_files:
                 print("Skipping " + filename, file=sys.stderr)
+            if included is not None:
+                included.append((context_directory, name, filename, None,
+                                 True, True))
             return IR.NullNode
+        if load_once:
+            required.append(filename)
         loadedfiles[filename] = True
     if Cmd.print_loaded_files:
         if filename != '-':
@@ -456,33 +698,161 @@ def parse_file(ppt, filename, load_once=False):
             print("Loading from standard input", file=sys.stderr)
     try:
         if filename != '-':
-            if context_directory is not None:
-                filename = os.path.join(context_directory, filename)
-            f = open(filename, "rt")
-            linelist = f.readlines()
-            f.close()
-            context_directory = os.path.abspath(os.path.dirname(filename))
+            with Files.mapped(filename) as data:
+                if included is not None:
+                    included.append((context_directory, name, filename,
+                                     Cache.digest(data), load_once, False))
+                context_directory = os.path.abspath(os.path.dirname(filename))
+                if Cache.enabled():
+                    nodes = parse_cached(filename, data)
+                else:
+                    nodes = iter_nodes(filename, Files.lines(data))
+                # The nodes are parsed as the sequence takes them,
+                # while the file is still mapped.
+                result = IR.SequenceNode(ppt, nodes)
         else:
             context_directory = os.getcwd()
-            linelist = sys.stdin.readlines()
-        pptlist = ["%s:%d" % (filename, i + 1) for i in range(len(linelist))]
-        lexlist = list(map(lex, pptlist, linelist))
-        IRlist = list(map(parse_line, pptlist, lexlist))
-        IRlist = [node for node in IRlist if node is not IR.NullNode]
+            result = IR.SequenceNode(ppt, iter_nodes(filename, sys.stdin))
         context_directory = old_context
-        return IR.SequenceNode(ppt, IRlist)
+        return result
     except IOError:
         Err.log("Could not read " + filename)
         context_directory = old_context
         return IR.NullNode
 
 
+def renumber_expr(expr, base):
+    "Returns expr with its anonymous labels numbered base higher."
+    if isinstance(expr, IR.LabelExpr):
+        if expr.data.startswith("*"):
+            return IR.LabelExpr("*%d" % (int(expr.data[1:]) + base))
+    elif isinstance(expr, IR.SequenceExpr):
+        return IR.SequenceExpr([renumber_expr(x, base) for x in expr.data])
+    elif isinstance(expr, (IR.HighByteExpr, IR.LowByteExpr)):
+        return type(expr)(renumber_expr(expr.data, base))
+    return expr
+
+
+def renumber(node, base):
+    """Renumbers the anonymous labels in the IR node as though base
+    anonymous labels had come before it."""
+    data = node.data
+    if node.nodetype == "Label" and data[0].startswith("*"):
+        data[0] = "*%d" % (int(data[0][1:]) + base)
+    for (i, x) in enumerate(data):
+        if isinstance(x, IR.Node):
+            renumber(x, base)
+        elif isinstance(x, IR.Expr):
+            data[i] = renumber_expr(x, base)
+
+
+worker_start = None
+
+
+def start_worker(settings, modnames, state):
+    "Prepares a worker process to parse files for parse_parallel."
+    global worker_start
+    Cmd.restore(settings)
+    pragmas.clear()
+    del pragma_modules[:]
+    for name in modnames:
+        register_pragmas(importlib.import_module(name))
+    Ops.select(Cmd.chipset())
+    worker_start = (settings, state)
+
+
+def parse_in_worker(filename):
+    """Parses one top-level file from the state the whole parse began
+    in, and reports what parse_parallel needs to splice it in."""
+    global loadedfiles, required, context_directory
+    (settings, state) = worker_start
+    Cmd.restore(settings)
+    set_parse_state(state)
+    loadedfiles = {}
+    required = []
+    context_directory = None
+    resolved_paths.clear()
+    path_stats.clear()
+    Err.count = 0
+    stderr = io.StringIO()
+    with contextlib.redirect_stderr(stderr):
+        node = parse_file("<Top Level>", filename)
+    (labels, modstates) = parse_state()
+    return (node, {"labels": labels,
+                   "state": modstates,
+                   "loaded": list(loadedfiles),
+                   "required": required,
+                   "outfile": Cmd.outfile,
+                   "listfile": Cmd.listfile,
+                   "errors": Err.count,
+                   "stderr": stderr.getvalue()})
+
+
+def parse_parallel(filenames):
+    """Parses the top-level files in worker processes, then stitches
+    them together in order.  The result is the same as parsing them
+    one after another: each worker starts from the state the parse
+    began in, and any file whose parse depended on what earlier files
+    changed is simply parsed again here."""
+    global templabelcount
+    settings = Cmd.snapshot()
+    state = parse_state()
+    modnames = [mod.__name__ for mod in pragma_modules]
+    nodes = []
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(Cmd.jobs, len(filenames)),
+            initializer=start_worker,
+            initargs=(settings, modnames, state)) as pool:
+        futures = [pool.submit(parse_in_worker, f) if f != '-' else None
+                   for f in filenames]
+        for (filename, future) in zip(filenames, futures):
+            # Standard input can't be handed to a worker, and a worker
+            # that failed outright is left to fail again here.
+            report = None
+            if future is not None:
+                try:
+                    (node, report) = future.result()
+                except Exception:
+                    pass
+            if report is None or state[1] != parse_state()[1] or \
+                    [f for f in report["required"] if f in loadedfiles]:
+                nodes.append(parse_file("<Top Level>", filename))
+                continue
+            sys.stderr.write(report["stderr"])
+            Err.count += report["errors"]
+            if templabelcount != 0:
+                renumber(node, templabelcount)
+            set_parse_state((templabelcount + report["labels"],
+                             report["state"]))
+            for f in report["loaded"]:
+                loadedfiles[f] = True
+            if Cmd.outfile is None and \
+                    report["outfile"] != settings["outfile"]:
+                Cmd.outfile = report["outfile"]
+            if Cmd.listfile is None and \
+                    report["listfile"] != settings["listfile"]:
+                Cmd.listfile = report["listfile"]
+            nodes.append(node)
+    return nodes
+
+
 def parse(filenames):
     """Top level parsing routine, taking a source file name
     list and returning an IR list."""
-    global templabelcount
+    global templabelcount, required
     templabelcount = 0
-    nodes = [parse_file("<Top Level>", f) for f in filenames]
+    required = []
+    resolved_paths.clear()
+    path_stats.clear()
+    if Cmd.jobs > 1 and len(filenames) > 1:
+        nodes = parse_parallel(filenames)
+    else:
+        nodes = [parse_file("<Top Level>", f) for f in filenames]
     if len(nodes) == 1:
         return nodes[0]
     return IR.SequenceNode("<Top level>", nodes)
+
+
+# The core pragmas register themselves when loaded, ahead of any
+# extension module.
+import Ophis.CorePragmas
@@ -7,13 +7,72 @@
 # You may use, modify, and distribute this file under the MIT
 # license: See README for details.
 
+import functools
+
 import Ophis.Errors as Err
 
 
+# Source file names, by file id, and file ids, by name.
+filenames = []
+file_ids = {}
+
+# Points within macro expansions, by the point in the macro's body and
+# the point of the invocation, so that every expansion made from one
+# invocation shares them.
+call_points = {}
+
+
+class ProgramPoint(object):
+    """A line of source, where nodes came from and errors are reported
+    Program points are formatted as "file:line" only when they are
+    printed.  Points within a macro expansion also know the point of
+    the invocation, which is shared by every node of the expansion;
+    they print as "invocation->line".  Points are pickled with their
+    file's name, since file ids only mean anything in one process."""
+    __slots__ = ("file", "line", "caller")
+
+    def __init__(self, filename, line, caller=None):
+        file = file_ids.get(filename)
+        if file is None:
+            file = file_ids[filename] = len(filenames)
+            filenames.append(filename)
+        self.file = file
+        self.line = line
+        self.caller = caller
+
+    def __str__(self):
+        point = "%s:%d" % (filenames[self.file], self.line)
+        if self.caller is None:
+            return point
+        return "%s->%s" % (self.caller, point)
+
+    def __repr__(self):
+        return repr(str(self))
+
+    def __reduce__(self):
+        return (ProgramPoint,
+                (filenames[self.file], self.line, self.caller))
+
+    def called_from(self, caller):
+        """Returns this point as reached through a macro invoked at the
+        point caller."""
+        key = (self, caller)
+        point = call_points.get(key)
+        if point is None:
+            if self.caller is not None:
+                caller = self.caller.called_from(caller)
+            point = call_points[key] = ProgramPoint(filenames[self.file],
+                                                    self.line, caller)
+        return point
+
+
 class Node(object):
     """The default IR Node
     Instances of Node always have the three fields ppt(Program Point),
-    nodetype(a string), and data (a list)."""
+    nodetype(a string), and data (a list), and no others: programs
+    have a great many nodes, so they are kept as small as possible."""
+    __slots__ = ("ppt", "nodetype", "data")
+
     def __init__(self, ppt, nodetype, *data):
         self.ppt = ppt
         self.nodetype = nodetype
@@ -22,10 +81,21 @@ class Node(object):
     def accept(self, asmpass, env=None):
         """Implements the Visitor pattern for an assembler pass.
         Calls the routine 'asmpass.visitTYPE(self, env)' where
-        TYPE is the value of self.nodetype."""
+        TYPE is the value of self.nodetype.  The routine for each
+        node type is found once per pass, and kept in the pass's
+        dispatch table, if it has one."""
         Err.currentpoint = self.ppt
-        routine = getattr(asmpass, "visit" + self.nodetype,
-                          asmpass.visitUnknown)
+        try:
+            routine = asmpass.dispatch[self.nodetype]
+        except KeyError:
+            routine = getattr(asmpass, "visit" + self.nodetype,
+                              asmpass.visitUnknown)
+            asmpass.dispatch[self.nodetype] = routine
+        except AttributeError:
+            # Passes whose __init__ does not call Pass.__init__ have
+            # no table, and look the routine up every time.
+            routine = getattr(asmpass, "visit" + self.nodetype,
+                              asmpass.visitUnknown)
         routine(self, env)
 
     def __str__(self):
@@ -44,14 +114,46 @@ NullNode = Node("<none>", "None")
 
 
 def SequenceNode(ppt, nodelist):
-    return Node(ppt, "SEQUENCE", *nodelist)
+    """Builds a SEQUENCE node of the nodes in nodelist, which may be
+    any iterable, read as they are produced."""
+    node = Node(ppt, "SEQUENCE")
+    node.data = list(nodelist)
+    return node
+
+
+def flatten(node):
+    """Returns a SEQUENCE node holding the nodes of the tree node, in
+    order, with every SEQUENCE node within it spliced into its place.
+    Passes may then visit a whole program in a single loop, however
+    deeply its files and macros were nested."""
+    nodes = []
+    stack = [iter([node])]
+    while stack:
+        for n in stack[-1]:
+            if n.nodetype == "SEQUENCE":
+                stack.append(iter(n.data))
+                break
+            nodes.append(n)
+        else:
+            stack.pop()
+    return SequenceNode(node.ppt, nodes)
 
 
 class Expr(object):
     """Base class for Ophis expressions
     All expressions have a field called "data" and a boolean field
     called "hardcoded".  An expression is hardcoded if it has no
-    symbolic values in it."""
+    symbolic values in it.  Like nodes, expressions have no fields
+    beyond those their class declares in __slots__.
+
+    Expressions are evaluated many times over, so the first call to
+    value() compiles the expression into a Python function of the
+    environment and keeps it in the evaluator field.  Likewise, the
+    labels an expression refers to are found once, and kept in the
+    free field.  Expressions must therefore not be changed once
+    built."""
+    __slots__ = ("data", "hardcoded", "evaluator", "free")
+
     def __init__(self, data):
         self.data = data
         self.hardcoded = False
@@ -59,6 +161,21 @@ class Expr(object):
     def __str__(self):
         return "<UNKNOWN: " + repr(self.data) + ">"
 
+    def __getstate__(self):
+        # Evaluators cannot be pickled, and they and the free labels
+        # are rebuilt on demand.
+        state = {}
+        for cls in type(self).__mro__:
+            for field in getattr(cls, "__slots__", ()):
+                if field not in ("evaluator", "free") and \
+                        hasattr(self, field):
+                    state[field] = getattr(self, field)
+        return state
+
+    def __setstate__(self, state):
+        for (field, value) in state.items():
+            setattr(self, field, value)
+
     def valid(self, env=None, PCvalid=False):
         """Returns true if the the expression can be successfully
         evaluated in the specified environment."""
@@ -66,14 +183,80 @@ class Expr(object):
 
     def value(self, env=None):
         "Evaluates this expression in the given environment."
-        return None
+        try:
+            evaluator = self.evaluator
+        except AttributeError:
+            evaluator = self.evaluator = compile_expr(self)
+        return evaluator(env)
+
+    def dependencies(self):
+        """Returns the set of labels this expression refers to, as a
+        frozenset, and whether it refers to the program counter."""
+        try:
+            return self.free
+        except AttributeError:
+            self.free = self.references()
+            return self.free
+
+    def references(self):
+        "Finds the dependencies of this expression."
+        return (no_labels, False)
+
+    def resolves(self, env=None, PCvalid=False):
+        """The valid() of expressions made of others: the expression
+        can be evaluated if every label it refers to is defined, and
+        the program counter, if it is used, is known.  Subexpressions
+        with a valid() of their own are asked instead."""
+        deps = self.dependencies()
+        if type(deps) is Dependencies:
+            for expr in deps.opaque:
+                if not expr.valid(env, PCvalid):
+                    return False
+            deps = deps.checked
+        (labels, pc) = deps
+        if pc and not (env is not None and PCvalid):
+            return False
+        return not labels or (env is not None and env.defines(labels))
+
+    def shape(self, args):
+        """Describes this expression for compile_expr: returns its
+        structure, as a hashable value, and appends the values in it
+        to the list args.  Expressions that define value() themselves
+        are simply asked for their value."""
+        if type(self).value is not Expr.value:
+            args.append(self)
+            return "value"
+        return "none"
 
 
 class ConstantExpr(Expr):
-    "Represents a numeric constant"
-    def __init__(self, data):
+    """Represents a numeric constant
+    Programs are full of small constants, so each one from 0 to $FFFF
+    is only ever built once: ConstantExpr(n) returns the same instance
+    every time.  Like all expressions, constants are never changed, so
+    nothing can tell the difference but the memory it saves."""
+    __slots__ = ()
+
+    def __new__(cls, data):
+        if cls is ConstantExpr and type(data) is int and \
+                0 <= data <= 0xFFFF:
+            self = interned_constants.get(data)
+            if self is None:
+                self = interned_constants[data] = Expr.__new__(cls)
+                self.data = data
+                self.hardcoded = True
+            return self
+        self = Expr.__new__(cls)
         self.data = data
         self.hardcoded = True
+        return self
+
+    # __new__ does all the work, so constructing an interned constant
+    # touches nothing.
+    __init__ = object.__init__
+
+    def __reduce__(self):
+        return (type(self), (self.data,))
 
     def __str__(self):
         return str(self.data)
@@ -84,9 +267,58 @@ class ConstantExpr(Expr):
     def value(self, env=None):
         return self.data
 
+    def shape(self, args):
+        args.append(self.data)
+        return "constant"
+
+
+class FoldedConstantExpr(ConstantExpr):
+    """A constant that constant folding made of an expression.  It
+    keeps the expression as written, in the source field, so that
+    messages about it still read as the programmer wrote it.  Folded
+    constants are never interned."""
+    __slots__ = ("source",)
+
+    def __new__(cls, data, source):
+        self = ConstantExpr.__new__(cls, data)
+        self.source = source
+        return self
+
+    def __reduce__(self):
+        return (type(self), (self.data, self.source))
+
+    def __str__(self):
+        return str(self.source)
+
+
+class FoldedExpr(Expr):
+    """An expression that constant folding simplified, but could not
+    reduce to a constant.  It evaluates as the simplified expression
+    in data, and reads as the expression as written, in source."""
+    __slots__ = ("source",)
+
+    def __init__(self, data, source):
+        self.data = data
+        self.source = source
+        self.hardcoded = data.hardcoded
+
+    def __str__(self):
+        return str(self.source)
+
+    def valid(self, env=None, PCvalid=False):
+        return self.data.valid(env, PCvalid)
+
+    def references(self):
+        return operand_dependencies(self.data)
+
+    def shape(self, args):
+        return self.data.shape(args)
+
 
 class LabelExpr(Expr):
     "Represents a symbolic constant"
+    __slots__ = ()
+
     def __init__(self, data):
         self.data = data
         self.hardcoded = False
@@ -97,12 +329,18 @@ class LabelExpr(Expr):
     def valid(self, env=None, PCvalid=False):
         return (env is not None) and self.data in env
 
-    def value(self, env=None):
-        return env[self.data]
+    def references(self):
+        return (frozenset([self.data]), False)
+
+    def shape(self, args):
+        args.append(self.data)
+        return "label"
 
 
 class PCExpr(Expr):
     "Represents the current program counter: ^"
+    __slots__ = ()
+
     def __init__(self):
         self.hardcoded = False
 
@@ -112,12 +350,17 @@ class PCExpr(Expr):
     def valid(self, env=None, PCvalid=False):
         return env is not None and PCvalid
 
-    def value(self, env=None):
-        return env.getPC()
+    def references(self):
+        return (no_labels, True)
+
+    def shape(self, args):
+        return "pc"
 
 
 class HighByteExpr(Expr):
     "Represents the expression >{data}"
+    __slots__ = ()
+
     def __init__(self, data):
         self.data = data
         self.hardcoded = data.hardcoded
@@ -125,16 +368,19 @@ class HighByteExpr(Expr):
     def __str__(self):
         return ">" + str(self.data)
 
-    def valid(self, env=None, PCvalid=False):
-        return self.data.valid(env, PCvalid)
+    valid = Expr.resolves
 
-    def value(self, env=None):
-        val = self.data.value(env)
-        return (val >> 8) & 0xff
+    def references(self):
+        return operand_dependencies(self.data)
+
+    def shape(self, args):
+        return ("high", self.data.shape(args))
 
 
 class LowByteExpr(Expr):
     "Represents the expression <{data}"
+    __slots__ = ()
+
     def __init__(self, data):
         self.data = data
         self.hardcoded = data.hardcoded
@@ -142,12 +388,13 @@ class LowByteExpr(Expr):
     def __str__(self):
         return "<" + str(self.data)
 
-    def valid(self, env=None, PCvalid=False):
-        return self.data.valid(env, PCvalid)
+    valid = Expr.resolves
 
-    def value(self, env=None):
-        val = self.data.value(env)
-        return val & 0xff
+    def references(self):
+        return operand_dependencies(self.data)
+
+    def shape(self, args):
+        return ("low", self.data.shape(args))
 
 
 class SequenceExpr(Expr):
@@ -155,6 +402,8 @@ class SequenceExpr(Expr):
     operators (of type String).  Subclasses must provide a routine
     operate(self, firstarg, op, secondarg) that evaluates the
     operator."""
+    __slots__ = ("operands", "operators")
+
     def __init__(self, data):
         """Constructor for Sequence Expressions.  Results will be
         screwy if the data inpot isn't a list with types
@@ -172,20 +421,17 @@ class SequenceExpr(Expr):
     def __str__(self):
         return "[" + " ".join(map(str, self.data)) + "]"
 
-    def valid(self, env=None, PCvalid=False):
-        for i in self.operands:
-            if not i.valid(env, PCvalid):
-                return False
-        return True
+    valid = Expr.resolves
 
-    def value(self, env=None):
-        subs = list(map((lambda x: x.value(env)), self.operands))
-        result = subs[0]
-        index = 1
-        for op in self.operators:
-            result = self.operate(result, op, subs[index])
-            index += 1
-        return result
+    def references(self):
+        return combine(self.operands)
+
+    def shape(self, args):
+        subs = tuple([x.shape(args) for x in self.operands])
+        if type(self).operate is SequenceExpr.operate:
+            return ("sequence", tuple(self.operators), subs)
+        args.append(self.operate)
+        return ("operate", tuple(self.operators), subs)
 
     def operate(self, start, op, other):
         if op == "*":
@@ -202,3 +448,129 @@ class SequenceExpr(Expr):
             return start | other
         if op == "^":
             return start ^ other
+
+
+# ConstantExpr instances, by value.
+interned_constants = {}
+
+# The labels of an expression that refers to none.
+no_labels = frozenset()
+
+# The valid() methods that hold just when every label an expression
+# refers to is defined, and the program counter is known if it uses
+# it.  Expressions made of others ask any subexpression with some
+# other valid() for its own answer.
+resolving = frozenset([Expr.resolves, ConstantExpr.valid, LabelExpr.valid,
+                       PCExpr.valid, FoldedExpr.valid])
+
+
+class Dependencies(tuple):
+    """The dependencies of an expression with subexpressions whose
+    validity doesn't follow from the labels they refer to.  It is the
+    usual pair of labels and program counter use, for everything the
+    expression refers to; opaque lists those subexpressions, and
+    checked is the pair for the rest of the expression."""
+
+    def __new__(cls, labels, pc, opaque, checked):
+        self = tuple.__new__(cls, (labels, pc))
+        self.opaque = opaque
+        self.checked = checked
+        return self
+
+
+def combine(operands):
+    "Returns the dependencies of an expression made of operands."
+    labels = set()
+    pc = False
+    checked = set()
+    checked_pc = False
+    opaque = []
+    for x in operands:
+        deps = x.dependencies()
+        labels.update(deps[0])
+        pc = pc or deps[1]
+        if type(x).valid not in resolving:
+            opaque.append(x)
+            continue
+        if type(deps) is Dependencies:
+            opaque.extend(deps.opaque)
+            deps = deps.checked
+        checked.update(deps[0])
+        checked_pc = checked_pc or deps[1]
+    if opaque:
+        return Dependencies(frozenset(labels), pc, opaque,
+                            (frozenset(checked), checked_pc))
+    return (frozenset(labels), pc)
+
+
+def operand_dependencies(expr):
+    "Returns the dependencies of an expression made of expr alone."
+    if type(expr).valid in resolving:
+        return expr.dependencies()
+    return combine([expr])
+
+# The Python spelling of each operator SequenceExpr.operate understands.
+operators = {"*": "*", "/": "//", "+": "+", "-": "-",
+             "&": "&", "|": "|", "^": "^"}
+
+# Evaluator functions, by the shape of the expressions they evaluate.
+# Expressions of the same shape share code, and differ only in the
+# arguments it is given.
+evaluators = {}
+
+
+def compile_expr(expr):
+    "Returns a function of the environment that evaluates expr."
+    args = []
+    shape = expr.shape(args)
+    key = (shape, len(args))
+    if key not in evaluators:
+        code = []
+        names = ["a%d" % i for i in range(len(args))]
+        result = generate(shape, code, iter(names))
+        source = "def evaluate(%s):\n" % ", ".join(names + ["env"])
+        source += "".join("    %s\n" % line for line in code)
+        source += "    return %s\n" % result
+        namespace = {}
+        exec(source, namespace)
+        evaluators[key] = namespace["evaluate"]
+    return functools.partial(evaluators[key], *args)
+
+
+def generate(shape, code, names):
+    """Appends Python statements evaluating an expression of the given
+    shape to the list code, and returns the name of the result.  The
+    expression's arguments are taken, in order, from names.  Operands
+    are all evaluated before any operator is applied, just as they
+    were before expressions were compiled."""
+    def temporary(expr):
+        code.append("t%d = %s" % (len(code), expr))
+        return "t%d" % (len(code) - 1)
+
+    if shape == "constant":
+        return next(names)
+    if shape == "label":
+        return temporary("env[%s]" % next(names))
+    if shape == "pc":
+        return temporary("env.getPC()")
+    if shape == "value":
+        return temporary("%s.value(env)" % next(names))
+    if shape == "none":
+        return "None"
+    if shape[0] == "high":
+        return temporary("(%s >> 8) & 0xff" % generate(shape[1], code, names))
+    if shape[0] == "low":
+        return temporary("%s & 0xff" % generate(shape[1], code, names))
+    (kind, ops, subs) = shape
+    subs = [generate(sub, code, names) for sub in subs]
+    if kind == "operate":
+        operate = next(names)
+    result = subs[0]
+    for (op, sub) in zip(ops, subs[1:]):
+        if kind == "operate":
+            result = temporary("%s(%s, %r, %s)" % (operate, result, op, sub))
+        elif op in operators:
+            result = temporary("%s %s %s" % (result, operators[op], sub))
+        else:
+            result = "None"
+    return result
@@ -58,7 +58,7 @@ def expandMacro(ppt, name, arglist):
                 for (i, arg) in zip(range(1, sys.maxsize), arglist)]
     bindexprs = [IR.Node(ppt, "Label", "_%d" % i, IR.LabelExpr("_*%d" % i))
                  for i in range(1, len(arglist) + 1)]
-    body = [IR.Node("%s->%s" % (ppt, node.ppt), node.nodetype, *node.data)
+    body = [IR.Node(node.ppt.called_from(ppt), node.nodetype, *node.data)
             for node in macros[name]]
     invocation = [IR.Node(ppt, "ScopeBegin")] + argexprs + \
                  [IR.Node(ppt, "ScopeBegin")] + bindexprs + body + \
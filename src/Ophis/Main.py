@@ -13,6 +13,7 @@ import Ophis.Frontend
 import Ophis.IR
 import Ophis.CorePragmas
 import Ophis.Passes
+import Ophis.Table
 import Ophis.Errors as Err
 import Ophis.Environment
 import Ophis.CmdLine
@@ -27,11 +28,15 @@ def run_all():
 
     """
     Err.count = 0
-    z = Ophis.Frontend.parse(Ophis.CmdLine.infiles)
+    Ophis.IR.call_points.clear()
+    Ophis.Passes.reset_profile()
+    with Ophis.Passes.profiling("Parsing"):
+        z = Ophis.IR.flatten(Ophis.Frontend.parse(Ophis.CmdLine.infiles))
     env = Ophis.Environment.Environment()
 
     m = Ophis.Passes.ExpandMacros()
     i = Ophis.Passes.InitLabels()
+    f = Ophis.Passes.FoldConstants(aliases=True)
     l_basic = Ophis.Passes.UpdateLabels()
     l = Ophis.Passes.FixPoint("label update", [l_basic],
                               lambda: not l_basic.changed)
@@ -42,6 +47,9 @@ def run_all():
     c = Ophis.Passes.FixPoint("instruction selection 1", [l, c_basic],
                               lambda: not c_basic.changed)
 
+    # Branch extension settles every branch it can in one run, so the
+    # outer fixpoint runs again only to redo the collapse for the labels
+    # that the extended branches moved.
     if Ophis.CmdLine.enable_branch_extend:
         b = Ophis.Passes.ExtendBranches()
         instruction_select = Ophis.Passes.FixPoint("instruction selection 2",
@@ -51,22 +59,45 @@ def run_all():
         instruction_select = c
     a = Ophis.Passes.Assembler()
 
+    expansion = []
+    expansion.append(Ophis.Passes.FoldConstants())
+    expansion.append(Ophis.Passes.DefineMacros())
+    expansion.append(Ophis.Passes.FixPoint("macro expansion", [m],
+                                           lambda: not m.changed))
+
+    # The program is kept flat, as a single sequence of nodes; macro
+    # expansions are flattened into it once they are all made.
     passes = []
-    passes.append(Ophis.Passes.DefineMacros())
-    passes.append(Ophis.Passes.FixPoint("macro expansion", [m],
-                                        lambda: not m.changed))
     passes.append(Ophis.Passes.FixPoint("label initialization", [i],
                                         lambda: not i.changed))
-    passes.extend([Ophis.Passes.CircularityCheck(),
-                   Ophis.Passes.CheckExprs(),
-                   Ophis.Passes.EasyModes()])
-    passes.append(instruction_select)
-    passes.extend([Ophis.Passes.NormalizeModes(),
-                   Ophis.Passes.UpdateLabels(),
-                   a])
-
+    passes.append(Ophis.Passes.FixPoint("constant folding", [f],
+                                        lambda: not f.changed))
+    passes.append(Ophis.Passes.Composite("validation",
+                                         [Ophis.Passes.CircularityCheck(),
+                                          Ophis.Passes.CheckExprs(),
+                                          Ophis.Passes.EasyModes()]))
+
+    # Instruction selection and assembly work on the program lowered
+    # to an instruction table.
+    lowered = []
+    lowered.append(instruction_select)
+    lowered.extend([Ophis.Passes.NormalizeModes(),
+                    Ophis.Passes.UpdateLabels(),
+                    a])
+
+    for p in expansion:
+        p.go(z, env)
+    with Ophis.Passes.profiling("Flattening"):
+        z = Ophis.IR.flatten(z)
     for p in passes:
         p.go(z, env)
+    with Ophis.Passes.profiling("Lowering"):
+        z = Ophis.Table.InstructionTable(z)
+    for p in lowered:
+        p.go(z, env)
+
+    if Ophis.CmdLine.profile_passes:
+        Ophis.Passes.print_profile()
 
     if Err.count == 0:
         try:
@@ -98,14 +129,7 @@ def run_all():
 
 def run_ophis(args):
     Ophis.CmdLine.parse_args(args)
-    Ophis.Frontend.pragma_modules.append(Ophis.CorePragmas)
-
-    if Ophis.CmdLine.enable_undoc_ops:
-        Ophis.Opcodes.opcodes.update(Ophis.Opcodes.undocops)
-    elif Ophis.CmdLine.enable_65c02_exts:
-        Ophis.Opcodes.opcodes.update(Ophis.Opcodes.c02extensions)
-    elif Ophis.CmdLine.enable_4502_exts:
-        Ophis.Opcodes.opcodes.update(Ophis.Opcodes.csg4502extensions)
+    Ophis.Opcodes.select(Ophis.CmdLine.chipset())
 
     Ophis.CorePragmas.reset()
     return run_all()
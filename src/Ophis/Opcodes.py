@@ -11,6 +11,8 @@
 # This file was automatically generated by gensets.py based on the
 # the tables in tools/opcodes. Edit those tables, not these.
 
+import types
+
 # Names of addressing modes
 modes = ["Implied",
          "Immediate",
@@ -612,3 +614,31 @@ csg4502extensions = {
                      'tza': [0x6B, None, None, None, None, None, None, None,
                              None, None, None, None, None, None, None, None, None, None, None, None, None],
                     }
+
+
+def _chipset(extensions):
+    table = dict((mnem, tuple(codes)) for (mnem, codes) in opcodes.items())
+    table.update((mnem, tuple(codes)) for (mnem, codes) in extensions.items())
+    return types.MappingProxyType(table)
+
+
+# Read-only instruction tables and mnemonic sets for each supported
+# chip, built once from the base instruction set and the chip's
+# extensions.  select() picks the ones an assembly uses; the tables
+# themselves are never changed.
+chipsets = {"6502": _chipset({}),
+            "6510": _chipset(undocops),
+            "65c02": _chipset(c02extensions),
+            "4502": _chipset(csg4502extensions)}
+mnemonic_sets = dict((chip, frozenset(table))
+                     for (chip, table) in chipsets.items())
+
+
+def select(chip):
+    "Makes the named chip's instruction set current."
+    global opcodes, mnemonics
+    opcodes = chipsets[chip]
+    mnemonics = mnemonic_sets[chip]
+
+
+select("6502")
@@ -0,0 +1,183 @@
+"""Persistent parse cache
+
+    Keeps the IR produced by parsing a source file on disk, keyed by
+    the file's contents and by every piece of assembler state that
+    parsing it depends on.  Each entry also lists the files the source
+    included or required, with their contents' digests, to be checked
+    before it is used.  Headers that never change need not be lexed
+    and parsed again on every run."""
+
+# Copyright 2002-2026 Michael C. Martin and additional contributors.
+# You may use, modify, and distribute this file under the MIT
+# license: See README for details.
+
+import hashlib
+import os
+import os.path
+import pickle
+import tempfile
+
+import Ophis.CmdLine as Cmd
+import Ophis.Files as Files
+
+# Upper bound, in bytes, on the total size of the cache directory.
+# The least recently used entries are evicted to stay under it.
+size_limit = 64 * 1024 * 1024
+
+disabled = False
+_fingerprint = None
+_module_digests = {}
+
+
+def default_directory():
+    "Returns the per-user cache directory."
+    base = os.environ.get("XDG_CACHE_HOME") or \
+        os.environ.get("LOCALAPPDATA") or \
+        os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "ophis")
+
+
+def directory():
+    if Cmd.parse_cache_dir is not None:
+        return Cmd.parse_cache_dir
+    return default_directory()
+
+
+def enabled():
+    return Cmd.parse_cache and not disabled
+
+
+def fingerprint():
+    """Hashes the assembler's own source, so that cache entries
+    written by any other version of Ophis are never used."""
+    global _fingerprint
+    if _fingerprint is None:
+        h = hashlib.sha256()
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(here)):
+            if name.endswith(".py"):
+                h.update(name.encode("utf-8"))
+                with open(os.path.join(here, name), "rb") as f:
+                    h.update(f.read())
+        _fingerprint = h.hexdigest()
+    return _fingerprint
+
+
+def module_digest(module):
+    """Hashes the name and source of a pragma module, or returns None
+    if it has no source file to hash."""
+    if module not in _module_digests:
+        digest = None
+        path = getattr(module, "__file__", None)
+        if path is not None:
+            h = hashlib.sha256()
+            h.update(module.__name__.encode("utf-8"))
+            try:
+                with open(path, "rb") as f:
+                    h.update(f.read())
+                digest = h.hexdigest()
+            except OSError:
+                pass
+        _module_digests[module] = digest
+    return _module_digests[module]
+
+
+def digest(data):
+    "Hashes the contents of an included file."
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_digest(path):
+    """Hashes the contents of the named file, or returns None if it
+    can't be read."""
+    try:
+        with Files.mapped(path) as data:
+            return digest(data)
+    except OSError:
+        return None
+
+
+def key(filename, data, state, modules):
+    """Computes the cache key for the file with the given name and
+    contents, parsed starting from the given state by the pragma
+    handlers in modules.  Returns None if the parse can't be keyed,
+    because some module has no source to hash."""
+    digests = [module_digest(mod) for mod in modules]
+    if None in digests:
+        return None
+    h = hashlib.sha256()
+    h.update(fingerprint().encode("ascii"))
+    h.update(repr((filename, state, digests)).encode("utf-8"))
+    h.update(data)
+    return h.hexdigest()
+
+
+def _entry(k):
+    return os.path.join(directory(), k + ".pickle")
+
+
+def load(k):
+    """Returns the (state, nodes, files) triple stored under key k, or
+    None if there is no usable entry."""
+    if not enabled():
+        return None
+    path = _entry(k)
+    try:
+        with open(path, "rb") as f:
+            result = pickle.load(f)
+        # Mark the entry as recently used.
+        os.utime(path)
+        return result
+    except FileNotFoundError:
+        return None
+    except Exception:
+        # Truncated or stale entries are simply misses.
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return None
+
+
+def store(k, state, nodes, files):
+    """Saves the state after parsing, the resulting IR, and the files
+    parsing read, under key k."""
+    global disabled
+    if not enabled():
+        return
+    try:
+        dirname = directory()
+        os.makedirs(dirname, exist_ok=True)
+        (fd, tmpname) = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump((state, nodes, files), f,
+                            pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpname, _entry(k))
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+        evict(dirname)
+    except (OSError, pickle.PicklingError, RecursionError):
+        # An unwritable cache just means we parse every time.
+        disabled = True
+
+
+def evict(dirname):
+    "Deletes least recently used entries until the cache fits its bound."
+    entries = []
+    total = 0
+    for entry in os.scandir(dirname):
+        if entry.name.endswith(".pickle"):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+    entries.sort()
+    for (mtime, size, path) in entries:
+        if total <= size_limit:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        total -= size
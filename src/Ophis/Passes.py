@@ -11,24 +11,44 @@
 # You may use, modify, and distribute this file under the MIT
 # license: See README for details.
 
+import contextlib
+import heapq
 import sys
+import time
 import Ophis.Errors as Err
 import Ophis.IR as IR
 import Ophis.Opcodes as Ops
 import Ophis.CmdLine as Cmd
 import Ophis.Listing as Listing
 import Ophis.Macro as Macro
+import Ophis.Table as Table
 
 
 class Pass(object):
     """Superclass for all assembler passes.  Automatically handles IR
     types that modify the environent's structure, and by default
     raises an error on anything else.  Override visitUnknown in your
-    extension pass to produce a pass that accepts everything."""
+    extension pass to produce a pass that accepts everything.
+
+    Each pass has a dispatch table from node types to the bound
+    methods that visit them, which nodes fill in as they are visited.
+    Passes with an __init__ of their own should call Pass.__init__ to
+    get one; those that don't still work, only more slowly."""
     name = "Default Pass"
 
+    # The node types that this pass does anything with, besides those
+    # Pass itself handles, or None if it may act on any node.  A
+    # Composite leaves a pass out of its visits to other nodes.
+    visits = None
+
+    # The number of table rows this run of the pass has visited, for
+    # passes that visit only some of them, or None if it visits every
+    # node.  --profile-passes counts rows rather than nodes for them.
+    rows = None
+
     def __init__(self):
         self.writeOK = True
+        self.dispatch = {}
 
     def visitNone(self, node, env):
         pass
@@ -38,6 +58,10 @@ class Pass(object):
         for n in node.data:
             n.accept(self, env)
 
+    def visitTable(self, node, env):
+        for n in node.data:
+            n.accept(self, env)
+
     def visitDataSegment(self, node, env):
         self.writeOK = False
         env.setsegment(node.data[0])
@@ -68,11 +92,13 @@ class Pass(object):
         if Err.count == 0:
             if Cmd.print_pass:
                 print("Running: " + self.name, file=sys.stderr)
-            env.reset()
-            self.prePass()
-            node.accept(self, env)
-            self.postPass()
-            env.reset()
+            self.rows = None
+            with profiling(self.name, node, owner=self):
+                env.reset()
+                self.prePass()
+                node.accept(self, env)
+                self.postPass()
+                env.reset()
             if Cmd.print_labels:
                 print("Current labels:", file=sys.stderr)
                 print(env, file=sys.stderr)
@@ -92,20 +118,217 @@ class FixPoint(object):
     def go(self, node, env):
         """Runs this FixPoint's passes, in order, until the fixpoint
         is true.  Always runs the passes at least once."""
-        for i in range(100):
-            if Err.count != 0:
-                break
-            for p in self.passes:
-                p.go(node, env)
-            if Err.count != 0:
-                break
-            if self.fixpoint():
-                break
-            if Cmd.print_pass:
-                print("Fixpoint failed, looping back", file=sys.stderr)
-        else:
-            Err.log("Can't make %s converge!  Maybe there's a recursive "
-                    "dependency somewhere?" % self.name)
+        with profiling(self.name, fixpoint=True, owner=self) as entry:
+            for i in range(100):
+                if Err.count != 0:
+                    break
+                if entry is not None:
+                    entry.iterations += 1
+                for p in self.passes:
+                    p.go(node, env)
+                if Err.count != 0:
+                    break
+                if self.fixpoint():
+                    break
+                if Cmd.print_pass:
+                    print("Fixpoint failed, looping back", file=sys.stderr)
+            else:
+                Err.log("Can't make %s converge!  Maybe there's a "
+                        "recursive dependency somewhere?" % self.name)
+
+
+class Composite(Pass):
+    """A pass made of several passes, which visits each node with each
+    of them in turn, so that the program is walked only once.  This has
+    the same effect as running the passes one after another, so long as
+    none of them looks at what another changes in other nodes, and all
+    of them leave the nodes that change the environment's structure to
+    Pass; it suits adjacent passes that check or rewrite nodes one at a
+    time.  Each node is visited only by the passes whose visits include
+    its type.
+
+    The errors each pass finds are held back until the walk is done,
+    and then logged pass by pass.  As with separate passes, once a pass
+    has found an error the passes after it visit no more nodes, and
+    their errors are dropped."""
+
+    def __init__(self, name, passes):
+        Pass.__init__(self)
+        self.name = name
+        self.passes = passes
+        self.held = []
+        self.errors = [[] for p in passes]
+        self.count = len(passes)
+
+    def go(self, node, env):
+        try:
+            with Err.holding(self.held):
+                Pass.go(self, node, env)
+        finally:
+            # Errors from the last reset of the environment, such as an
+            # unmatched scope, are the first pass's.
+            self.catch(0)
+            for errors in self.errors:
+                if Err.count != 0:
+                    break
+                for (point, err) in errors:
+                    Err.currentpoint = point
+                    Err.log(err)
+            self.errors = [[] for p in self.passes]
+            self.count = len(self.passes)
+            self.dispatch = {}
+
+    def prePass(self):
+        for p in self.passes:
+            p.prePass()
+
+    def postPass(self):
+        for p in self.passes:
+            p.postPass()
+
+    def catch(self, index):
+        """Takes the errors held since the last catch as those of pass
+        index, and stops the passes after it from visiting any more
+        nodes."""
+        if self.held:
+            self.errors[index].extend(self.held)
+            del self.held[:]
+            self.count = min(self.count, index + 1)
+            self.dispatch = {}
+
+    def visitScopeEnd(self, node, env):
+        Pass.visitScopeEnd(self, node, env)
+        self.catch(0)
+
+    def visitUnknown(self, node, env):
+        nodetype = node.nodetype
+        stages = []
+        for index in range(self.count):
+            p = self.passes[index]
+            if p.visits is None or nodetype in p.visits:
+                stages.append((index, getattr(p, "visit" + nodetype,
+                                              p.visitUnknown)))
+        held = self.held
+
+        def visit(node, env):
+            for (index, routine) in stages:
+                routine(node, env)
+                if held or node.nodetype != nodetype:
+                    self.resume(node, env, index)
+                    return
+        self.dispatch[nodetype] = visit
+        visit(node, env)
+
+    def resume(self, node, env, index):
+        """Finishes visiting a node after pass index found an error in
+        it or changed its type."""
+        while True:
+            if self.held:
+                self.catch(index)
+                return
+            index += 1
+            if index >= self.count:
+                return
+            p = self.passes[index]
+            if p.visits is None or node.nodetype in p.visits:
+                getattr(p, "visit" + node.nodetype,
+                        p.visitUnknown)(node, env)
+
+
+class PassProfile(object):
+    """The time spent in one pass, fixpoint, or other stage of
+    assembly, over all of its runs, for --profile-passes.  Passes count
+    the nodes or table rows they visit, and fixpoints count how many
+    times they ran their passes.  A pass that visits only some rows of
+    a table counts those it visits."""
+    __slots__ = ("name", "runs", "wall", "cpu", "nodes", "iterations")
+
+    def __init__(self, name):
+        self.name = name
+        self.runs = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.nodes = None
+        self.iterations = None
+
+
+# Profiles of everything run since reset_profile, by the pass or
+# fixpoint that ran, or by name for the other stages.
+profile = {}
+
+
+def reset_profile():
+    profile.clear()
+
+
+@contextlib.contextmanager
+def profiling(name, node=None, fixpoint=False, owner=None):
+    """Times the body of the with statement, if --profile-passes was
+    given, and adds it to the profile of owner, the pass or fixpoint
+    running it, or to the profile with the given name if there is no
+    owner.  The body is given that profile, or None if there is none.
+    If node is given, the body is a pass over it; if fixpoint is true,
+    the body is a fixpoint, which counts its own iterations.  Profiles
+    of different owners with the same name are numbered apart."""
+    if not Cmd.profile_passes:
+        yield None
+        return
+    key = name if owner is None else owner
+    entry = profile.get(key)
+    if entry is None:
+        label = name
+        names = set(e.name for e in profile.values())
+        number = 1
+        while label in names:
+            number += 1
+            label = "%s (%d)" % (name, number)
+        entry = profile[key] = PassProfile(label)
+    if node is not None and entry.nodes is None:
+        entry.nodes = 0
+    if fixpoint and entry.iterations is None:
+        entry.iterations = 0
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield entry
+    finally:
+        entry.wall += time.perf_counter() - wall
+        entry.cpu += time.process_time() - cpu
+        entry.runs += 1
+        if node is not None:
+            if owner is not None and owner.rows is not None:
+                entry.nodes += owner.rows
+            else:
+                entry.nodes += count_nodes(node)
+
+
+def count_nodes(node):
+    """Returns the number of nodes, or table rows, a pass over node
+    visits if it visits all of them."""
+    if node.nodetype == "Table":
+        return len(node.data)
+    count = 0
+    stack = [node]
+    while stack:
+        n = stack.pop()
+        count += 1
+        if n.nodetype == "SEQUENCE":
+            stack.extend(n.data)
+    return count
+
+
+def print_profile():
+    "Prints the profiles, the slowest first."
+    print("Pass profile:", file=sys.stderr)
+    print("%9s %9s %6s %6s %10s  %s" % ("Wall(s)", "CPU(s)", "Runs",
+                                        "Iters", "Nodes", "Name"),
+          file=sys.stderr)
+    for entry in sorted(profile.values(), key=lambda e: -e.wall):
+        print("%9.3f %9.3f %6d %6s %10s  %s" %
+              (entry.wall, entry.cpu, entry.runs,
+               "-" if entry.iterations is None else entry.iterations,
+               "-" if entry.nodes is None else entry.nodes,
+               entry.name), file=sys.stderr)
 
 
 class DefineMacros(Pass):
@@ -207,9 +430,62 @@ class InitLabels(Pass):
         pass
 
 
+class FoldConstants(Pass):
+    """Replaces every hardcoded subexpression with a single constant,
+    and drops operations that cannot change a value, such as the +0
+    in ^+0.  If aliases is true, labels defined as constants are
+    replaced by their values as well, which makes the expressions that
+    use them hardcoded.  This may take several runs, since an alias
+    may be used before it is defined."""
+    name = "Constant folding pass"
+
+    def __init__(self, aliases=False):
+        Pass.__init__(self)
+        self.aliases = aliases
+        self.constants = {}
+
+    def prePass(self):
+        self.changed = False
+
+    def lookup(self, label, env):
+        "Returns the constant the label was defined as, if any."
+        if label[0] == '_':
+            for scope in env.stack:
+                if (scope, label) in self.constants:
+                    return self.constants[(scope, label)]
+            return None
+        return self.constants.get(label)
+
+    def foldData(self, node, env):
+        if self.aliases:
+            lookup = lambda label: self.lookup(label, env)
+        else:
+            lookup = None
+        data = node.data
+        for (i, x) in enumerate(data):
+            if isinstance(x, IR.Expr):
+                folded = fold(x, lookup)
+                if folded is not x:
+                    data[i] = as_written(folded, getattr(x, "source", x))
+
+    def visitLabel(self, node, env):
+        self.foldData(node, env)
+        (label, val) = node.data
+        if self.aliases and isinstance(val, IR.ConstantExpr):
+            if label[0] == '_':
+                label = (env.stack[0], label)
+            if label not in self.constants:
+                self.constants[label] = val
+                self.changed = True
+
+    def visitUnknown(self, node, env):
+        self.foldData(node, env)
+
+
 class CircularityCheck(Pass):
     "Checks for circular label dependencies"
     name = "Circularity check pass"
+    visits = frozenset(["Advance", "SetPC", "CheckPC", "Label"])
 
     def prePass(self):
         self.changed = False
@@ -253,6 +529,9 @@ class CheckExprs(Pass):
 class EasyModes(Pass):
     "Assigns address modes to hardcoded and branch instructions"
     name = "Easy addressing modes pass"
+    visits = frozenset(["Memory", "MemoryX", "MemoryY", "Memory2",
+                        "Pointer", "PointerX", "PointerY", "PointerSPY",
+                        "PointerZ"])
 
     def visitMemory(self, node, env):
         if Ops.opcodes[node.data[0]][Ops.modes.index("Relative")] is not None:
@@ -410,6 +689,9 @@ class PCTracker(Pass):
     def visitByte(self, node, env):
         env.incPC(len(node.data))
 
+    def visitBlob(self, node, env):
+        env.incPC(len(node.data[0]))
+
     def visitByteRange(self, node, env):
         if node.data[1].valid(env):
             env.incPC(node.data[1].value(env))
@@ -441,6 +723,106 @@ class UpdateLabels(PCTracker):
         if old != env[label]:
             self.changed = True
 
+    # Over an instruction table, the first update walks every row and
+    # finds the table's layout.  Later updates visit only the rows of
+    # mode OTHER, which may move the program counter anywhere, and the
+    # labels that may have changed: those after a row that changed
+    # size or a program counter that moved, if they use the program
+    # counter, and those that use a label that changed.
+
+    def visitTable(self, node, env):
+        if node.layout is None:
+            self.layOut(node, env)
+        else:
+            self.update(node, env)
+
+    def layOut(self, node, env):
+        modes = node.modes
+        sizes = node.sizes
+        exits = {}
+        changes = []
+        pc = env.getPC()
+        for i in range(len(modes)):
+            mode = modes[i]
+            if mode < Table.LABEL:
+                pc += sizes[i]
+            elif mode == Table.LABEL:
+                env.setPC(pc)
+                label = self.updateLabel(node, i, env)
+                if label is not None:
+                    changes.append((i, label))
+            else:
+                env.setPC(pc)
+                node.data[i].accept(self, env)
+                pc = exits[i] = env.getPC()
+        env.setPC(pc)
+        node.layout = Table.Layout(node, exits)
+        for (i, label) in changes:
+            self.relabel(node, i, label, None, None)
+
+    def update(self, node, env):
+        """Updates the labels of a table that has a layout, and returns
+        the names of those that changed value."""
+        layout = node.layout
+        modes = node.modes
+        sums = layout.sums
+        queue = sorted(layout.dirty.union(layout.anchors))
+        queued = set(queue)
+        layout.dirty = set()
+        changes = []
+        start = 0
+        pc = env.getPC()
+        self.rows = self.rows or 0
+        while queue:
+            i = heapq.heappop(queue)
+            self.rows += 1
+            env.setPC(pc + sums.total(i) - start)
+            if modes[i] == Table.LABEL:
+                label = self.updateLabel(node, i, env)
+                if label is not None:
+                    changes.append(label)
+                    self.relabel(node, i, label, queue, queued)
+            else:
+                node.data[i].accept(self, env)
+                start = sums.total(i + 1)
+                pc = env.getPC()
+                if layout.exits[i] != pc:
+                    layout.exits[i] = pc
+                    for row in layout.shifted(i):
+                        if row not in queued:
+                            queued.add(row)
+                            heapq.heappush(queue, row)
+        return changes
+
+    def updateLabel(self, node, row, env):
+        """Updates the label defined in row, and returns its name if its
+        value changed."""
+        Err.currentpoint = node.data[row].ppt
+        label = node.labelnames[node.labels[row]]
+        old = env[label]
+        env[label] = node.exprs[node.operands[row]].value(env)
+        if old != env[label]:
+            self.changed = True
+            return label
+        return None
+
+    def relabel(self, node, row, label, queue, queued):
+        """Marks what depends on a label that changed value in row.
+        Later label rows are added to queue, if there is one, and
+        others are left for the next update."""
+        layout = node.layout
+        for dependent in node.dependents().get(label, ()):
+            if layout.stale is not None:
+                layout.stale.add(dependent)
+            if node.modes[dependent] != Table.LABEL:
+                continue
+            if queue is not None and dependent > row:
+                if dependent not in queued:
+                    queued.add(dependent)
+                    heapq.heappush(queue, dependent)
+            else:
+                layout.dirty.add(dependent)
+
 
 class Collapse(PCTracker):
     "Selects as many zero-page instructions to convert as possible."
@@ -516,6 +898,128 @@ class Collapse(PCTracker):
                 return
         PCTracker.visitZeroPageY(self, node, env)
 
+    # The same selections, by row mode, for instruction tables.
+    shrink = {Table.MEMORY: Table.ZEROPAGE,
+              Table.MEMORYX: Table.ZEROPAGEX,
+              Table.MEMORYY: Table.ZEROPAGEY,
+              Table.POINTER: Table.ZPINDIRECT,
+              Table.POINTERX: Table.INDIRECTX,
+              Table.POINTERY: Table.INDIRECTY}
+    grow = {Table.IMMEDIATE: Table.IMMEDIATELONG,
+            Table.ZEROPAGE: Table.ABSOLUTE,
+            Table.ZEROPAGEX: Table.ABSOLUTEX,
+            Table.ZEROPAGEY: Table.ABSOLUTEY}
+
+    def visitTable(self, node, env):
+        modes = node.modes
+        sizes = node.sizes
+        codes = [Ops.opcodes[name] for name in node.mnemonics]
+        # Only the instructions whose arguments may have changed value
+        # since the last selection need another look.
+        stale = None
+        if node.layout is not None and node.layout.stale is not None:
+            stale = node.layout.stale.union(node.dependents().get("^", ()))
+        pc = env.getPC()
+        for i in range(len(modes)):
+            mode = modes[i]
+            size = sizes[i]
+            if stale is not None and i not in stale:
+                if mode == Table.OTHER:
+                    env.setPC(pc)
+                    node.data[i].accept(self, env)
+                    size = env.getPC() - pc
+            elif mode in Collapse.shrink or mode in Collapse.grow:
+                Err.currentpoint = node.data[i].ppt
+                env.setPC(pc)
+                if node.exprs[node.operands[i]].value(env) < 0x100:
+                    target = Collapse.shrink.get(mode)
+                else:
+                    target = Collapse.grow.get(mode)
+                if target is not None and \
+                        codes[node.opcodes[i]][target] is not None:
+                    node.retype(i, target)
+                    self.changed = True
+                    # As in the visitors above, an instruction that
+                    # shrinks keeps its old size for the rest of the
+                    # pass, to match the labels already computed.
+                    if mode in Collapse.grow:
+                        size = sizes[i]
+            elif mode == Table.OTHER:
+                env.setPC(pc)
+                node.data[i].accept(self, env)
+                size = env.getPC() - pc
+            pc += size
+        env.setPC(pc)
+        if node.layout is not None:
+            node.layout.stale = set()
+
+
+# For each operator, the constant right operand that leaves the left
+# operand unchanged.
+identities = {"+": 0, "-": 0, "|": 0, "^": 0, "*": 1, "/": 1}
+
+
+def fold(expr, lookup=None):
+    """Returns expr with its hardcoded subexpressions replaced by
+    constants.  If lookup is given, it maps label names to the
+    constants they stand for, or to None.  Division by zero is left
+    for evaluation to report."""
+    if isinstance(expr, IR.LabelExpr):
+        if lookup is not None:
+            constant = lookup(expr.data)
+            if constant is not None:
+                return constant
+    elif isinstance(expr, IR.FoldedExpr):
+        sub = fold(expr.data, lookup)
+        if sub is not expr.data:
+            return sub
+    elif isinstance(expr, (IR.HighByteExpr, IR.LowByteExpr)):
+        sub = fold(expr.data, lookup)
+        if sub is not expr.data:
+            expr = type(expr)(sub)
+        if isinstance(sub, IR.ConstantExpr):
+            return IR.ConstantExpr(expr.value())
+    elif isinstance(expr, IR.SequenceExpr):
+        return fold_sequence(expr, lookup)
+    return expr
+
+
+def as_written(expr, source):
+    """Returns the folded expression expr, marked as having been
+    written as source, for error messages."""
+    if isinstance(expr, IR.ConstantExpr):
+        return IR.FoldedConstantExpr(expr.data, source)
+    return IR.FoldedExpr(expr, source)
+
+
+def fold_sequence(expr, lookup):
+    operands = [fold(x, lookup) for x in expr.operands]
+    operators = expr.operators
+    # Evaluation is strictly left to right, so any constant prefix may
+    # be computed now...
+    result = operands[0]
+    index = 0
+    while index < len(operators) and result.hardcoded and \
+            operands[index + 1].hardcoded:
+        try:
+            result = IR.ConstantExpr(expr.operate(result.value(),
+                                                  operators[index],
+                                                  operands[index + 1].value()))
+        except ZeroDivisionError:
+            break
+        index += 1
+    # ... and any later operation with its identity dropped.
+    data = [result]
+    for (op, operand) in zip(operators[index:], operands[index + 1:]):
+        if not (isinstance(operand, IR.ConstantExpr) and
+                identities.get(op) == operand.data):
+            data.extend([op, operand])
+    if len(data) == 1:
+        return result
+    if data == expr.data:
+        return expr
+    return IR.SequenceExpr(data)
+
 
 def collapse_no_index(node, env):
     """Transforms a Memory node into a ZeroPage one if possible.
@@ -625,6 +1129,10 @@ class ExtendBranches(PCTracker):
                 'bbs7': 'bbr7'
                 }
 
+    def __init__(self):
+        Pass.__init__(self)
+        self.labels = UpdateLabels()
+
     def prePass(self):
         self.changed = False
 
@@ -700,6 +1208,103 @@ class ExtendBranches(PCTracker):
         else:
             PCTracker.visitZPRelative(self, node, env)
 
+    # Over an instruction table with a layout, the branches are kept on
+    # a worklist.  The first sweep checks every branch; each later one
+    # checks only the branches that the extensions of the sweep before
+    # moved, or whose targets they moved, once the labels are brought
+    # up to date.  The rows of the extended branches are replaced once
+    # there is nothing left to check.
+
+    def visitTable(self, node, env):
+        if node.layout is None:
+            self.walk(node, env)
+        else:
+            self.sweep(node, env)
+
+    def walk(self, node, env):
+        modes = node.modes
+        sizes = node.sizes
+        pc = env.getPC()
+        i = 0
+        while i < len(modes):
+            mode = modes[i]
+            if mode == Table.RELATIVE or mode == Table.ZPRELATIVE or \
+                    mode == Table.OTHER:
+                env.setPC(pc)
+                i += node.visit(i, self, env)
+                pc = env.getPC()
+            else:
+                pc += sizes[i]
+                i += 1
+        env.setPC(pc)
+
+    def sweep(self, node, env):
+        layout = node.layout
+        modes = node.modes
+        sizes = node.sizes
+        sums = layout.sums
+        branches = [i for i in range(len(modes))
+                    if modes[i] == Table.RELATIVE or
+                    modes[i] == Table.ZPRELATIVE]
+        exits = dict(layout.exits)
+        extended = set()
+        work = set(branches)
+        self.rows = 0
+        while work and Err.count == 0:
+            queue = sorted(work.union(layout.anchors))
+            queued = set(queue)
+            work = set()
+            grown = []
+            start = 0
+            pc = env.getPC()
+            while queue:
+                i = heapq.heappop(queue)
+                self.rows += 1
+                env.setPC(pc + sums.total(i) - start)
+                branch = node.data[i]
+                branch.accept(self, env)
+                if modes[i] != Table.OTHER:
+                    if branch.nodetype != Table.nodetypes[modes[i]]:
+                        grown.append(i)
+                    continue
+                start = sums.total(i + 1)
+                pc = env.getPC()
+                if exits[i] != pc:
+                    exits[i] = pc
+                    for row in layout.shifted(i, branches):
+                        if row not in queued and row not in extended:
+                            queued.add(row)
+                            heapq.heappush(queue, row)
+            if not grown:
+                break
+            # Every branch in the sweep was checked against the same
+            # layout, so each one extended had to be.  Not every
+            # extension moves the program counter past itself, so
+            # measure what the branch became.  Any of them moves the
+            # labels after it, so selection must run again.
+            self.changed = True
+            for i in grown:
+                extended.add(i)
+                size = sum(Table.size(n, Table.modes.get(n.nodetype,
+                                                         Table.OTHER))
+                           for n in Table.rows(node.data[i]))
+                layout.resize(i, size - sizes[i])
+                sizes[i] = size
+                work.update(layout.shifted(i, branches))
+            env.reset()
+            self.labels.rows = 0
+            changes = self.labels.update(node, env)
+            self.rows += self.labels.rows
+            env.reset()
+            dependents = node.dependents()
+            for label in changes:
+                work.update(row for row in dependents.get(label, ())
+                            if modes[row] == Table.RELATIVE or
+                            modes[row] == Table.ZPRELATIVE)
+            work.difference_update(extended)
+        for i in sorted(extended, reverse=True):
+            node.replace(i, [node.data[i]])
+
 
 class NormalizeModes(Pass):
     """Eliminates the intermediate "Memory" and "Pointer" nodes,
@@ -732,6 +1337,25 @@ class NormalizeModes(Pass):
     def visitUnknown(self, node, env):
         pass
 
+    normal = {Table.MEMORY: Table.ABSOLUTE,
+              Table.MEMORYX: Table.ABSOLUTEX,
+              Table.MEMORYY: Table.ABSOLUTEY,
+              Table.POINTER: Table.INDIRECT,
+              Table.POINTERX: Table.ABSINDX,
+              Table.POINTERY: Table.ABSINDY}
+
+    def visitTable(self, node, env):
+        modes = node.modes
+        i = 0
+        while i < len(modes):
+            mode = modes[i]
+            if mode in NormalizeModes.normal:
+                node.retype(i, NormalizeModes.normal[mode])
+            elif mode == Table.OTHER:
+                i += node.visit(i, self, env)
+                continue
+            i += 1
+
 
 class Assembler(Pass):
     """Converts the IR into a list of bytes, suitable for writing to
@@ -746,7 +1370,7 @@ class Assembler(Pass):
     # PC is changed by an .org, which may happen in the middle of
     # data definition blocks.
     def prePass(self):
-        self.output = []
+        self.output = bytearray()
         self.code = 0
         self.data = 0
         self.filler = 0
@@ -781,6 +1405,17 @@ class Assembler(Pass):
         else:
             Err.log("Attempt to write to data segment")
 
+    def outputblob(self, blob, pc):
+        "Outputs a bytes object, which needs no range checking"
+        if self.writeOK:
+            self.output += blob
+            self.registerData(blob, pc)
+        else:
+            # One complaint per byte, just as for individual bytes
+            for i in range(len(blob)):
+                Err.log("Attempt to write to data segment")
+            self.registerData([], pc)
+
     def outputword(self, expr, env, tee=None):
         'Outputs a little-endian word, with range checking'
         if self.writeOK:
@@ -1004,6 +1639,16 @@ class Assembler(Pass):
         location = val.value(env)
         self.mapper.mapLabel(label, str(node.ppt), location)
 
+    def visitTable(self, node, env):
+        modes = node.modes
+        for i in range(len(modes)):
+            mode = modes[i]
+            if mode < Table.MEMORY:
+                Err.currentpoint = node.data[i].ppt
+                self.assemble(node.data[i], mode, env)
+            else:
+                node.data[i].accept(self, env)
+
     def visitByte(self, node, env):
         created = []
         for expr in node.data:
@@ -1012,22 +1657,31 @@ class Assembler(Pass):
         env.incPC(len(node.data))
         self.data += len(node.data)
 
+    def visitBlob(self, node, env):
+        self.outputblob(node.data[0], env.getPC())
+        env.incPC(len(node.data[0]))
+        self.data += len(node.data[0])
+
     def visitByteRange(self, node, env):
-        offset = node.data[0].value(env) + 2
-        length = node.data[1].value(env)
-        if offset < 2:
+        (offset, length, blob) = node.data
+        offset = offset.value(env)
+        length = length.value(env)
+        if offset < 0:
             Err.log("Negative offset in .incbin")
-        elif offset > len(node.data):
+        elif offset > len(blob):
             Err.log("Offset extends past end of file")
         elif length < 0:
             Err.log("Negative length")
-        elif offset + length > len(node.data):
+        elif offset + length > len(blob):
             Err.log("File too small for .incbin subrange")
         else:
-            created = []
-            for expr in node.data[offset:(offset + length)]:
-                self.outputbyte(expr, env, created)
-            self.registerData(created, env.getPC())
+            # The data may be a Files.LazyFile, which reads it now.
+            try:
+                data = blob[offset:(offset + length)]
+            except IOError:
+                Err.log("Could not read " + str(blob))
+                return
+            self.outputblob(data, env.getPC())
             env.incPC(length)
             self.data += length
 
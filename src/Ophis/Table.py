@@ -0,0 +1,284 @@
+"""Instruction tables
+
+    The lowered form of a program that instruction selection and
+    assembly work on.  Once macros are expanded, the program's nodes
+    are laid out in a single table, with the facts those passes need
+    about each node kept in parallel integer columns."""
+
+# Copyright 2002-2026 Michael C. Martin and additional contributors.
+# You may use, modify, and distribute this file under the MIT
+# license: See README for details.
+
+import array
+import bisect
+
+import Ophis.IR as IR
+import Ophis.Opcodes as Ops
+
+
+# Row modes.  The first are the selected address modes, in the order of
+# Ops.modes, so that a row's mode is also its index into the opcode
+# tables; then the modes yet to be selected; then the nodes of a fixed
+# size, the last of which is Label.  Rows of any other node type have
+# mode OTHER, and are always visited as nodes.
+nodetypes = ["Implied", "Immediate", "ImmediateLong",
+             "ZeroPage", "ZeroPageX", "ZeroPageY",
+             "Absolute", "AbsoluteX", "AbsoluteY",
+             "Indirect", "AbsIndX", "AbsIndY", "AbsIndZ",
+             "ZPIndirect", "IndirectX", "IndirectY", "IndirectSPY",
+             "IndirectZ", "Relative", "RelativeLong", "ZPRelative",
+             "Memory", "MemoryX", "MemoryY", "MemoryZ",
+             "Pointer", "PointerX", "PointerY",
+             "Byte", "Word", "Dword", "WordBE", "DwordBE", "Blob",
+             "CheckPC", "Label"]
+(IMPLIED, IMMEDIATE, IMMEDIATELONG,
+ ZEROPAGE, ZEROPAGEX, ZEROPAGEY,
+ ABSOLUTE, ABSOLUTEX, ABSOLUTEY,
+ INDIRECT, ABSINDX, ABSINDY, ABSINDZ,
+ ZPINDIRECT, INDIRECTX, INDIRECTY, INDIRECTSPY,
+ INDIRECTZ, RELATIVE, RELATIVELONG, ZPRELATIVE,
+ MEMORY, MEMORYX, MEMORYY, MEMORYZ,
+ POINTER, POINTERX, POINTERY,
+ BYTE, WORD, DWORD, WORDBE, DWORDBE, BLOB,
+ CHECKPC, LABEL) = range(len(nodetypes))
+OTHER = len(nodetypes)
+
+modes = dict((nodetype, mode) for (mode, nodetype) in enumerate(nodetypes))
+
+# The name under which dependents lists the rows that use the program
+# counter.  No label can have it.
+pc_label = frozenset(["^"])
+
+# Bytes per expression of each data node.
+widths = {BYTE: 1, WORD: 2, DWORD: 4, WORDBE: 2, DWORDBE: 4}
+
+
+def rows(node):
+    "Returns the nodes of the tree node that become table rows, in order."
+    return [n for n in IR.flatten(node).data if n.nodetype != "None"]
+
+
+class InstructionTable(IR.Node):
+    """A program lowered for instruction selection and assembly.  The
+    table's data is the list of the program's nodes, in order and
+    without SEQUENCE or None nodes; each row also has an entry in the
+    columns
+
+        modes     its mode, from the list above
+        opcodes   its instruction, as an index into mnemonics, or -1
+        sizes     its size in bytes, if its mode is below OTHER
+        operands  its argument or label value, as an index into exprs,
+                  or -1
+        labels    the label it defines, as an index into labelnames,
+                  or -1
+
+    The dependents of each label, the rows whose expressions refer to
+    it, are found from the expressions when first asked for.  The
+    table's layout, once a label update has found one, is kept in step
+    with the sizes of its rows.
+
+    The table is itself a node, of type Table.  Passes that know about
+    tables loop over the columns in visitTable; others visit each row
+    as a node.  The table keeps the node types of its rows in step
+    with their modes, and a pass that rewrites a row's node must have
+    the table re-lower it."""
+    __slots__ = ("modes", "opcodes", "sizes", "operands", "labels",
+                 "mnemonics", "exprs", "labelnames", "opcode_ids",
+                 "reverse", "layout")
+
+    def __init__(self, node):
+        IR.Node.__init__(self, node.ppt, "Table")
+        self.modes = array.array('B')
+        self.opcodes = array.array('h')
+        self.sizes = array.array('l')
+        self.operands = array.array('l')
+        self.labels = array.array('l')
+        self.mnemonics = []
+        self.opcode_ids = {}
+        self.exprs = []
+        self.labelnames = []
+        self.data = []
+        self.reverse = None
+        self.layout = None
+        self.extend(rows(node))
+
+    def __str__(self):
+        return "\n".join(map(str, self.data))
+
+    def lower(self, node):
+        "Returns the columns of the row for node."
+        mode = modes.get(node.nodetype, OTHER)
+        opcode = -1
+        operand = -1
+        label = -1
+        if mode < BYTE:
+            name = node.data[0]
+            opcode = self.opcode_ids.get(name)
+            if opcode is None:
+                opcode = self.opcode_ids[name] = len(self.mnemonics)
+                self.mnemonics.append(name)
+            if node.data[1] is not None:
+                operand = len(self.exprs)
+                self.exprs.append(node.data[1])
+        elif mode == LABEL:
+            label = len(self.labelnames)
+            self.labelnames.append(node.data[0])
+            operand = len(self.exprs)
+            self.exprs.append(node.data[1])
+        return (mode, opcode, size(node, mode), operand, label)
+
+    def extend(self, nodes):
+        "Adds rows for each of the nodes to the end of the table."
+        self.reverse = None
+        self.layout = None
+        for node in nodes:
+            (mode, opcode, size, operand, label) = self.lower(node)
+            self.data.append(node)
+            self.modes.append(mode)
+            self.opcodes.append(opcode)
+            self.sizes.append(size)
+            self.operands.append(operand)
+            self.labels.append(label)
+
+    def replace(self, index, nodes):
+        """Replaces row index with rows for the tree nodes, and returns
+        the number of rows put in its place."""
+        self.reverse = None
+        self.layout = None
+        nodes = [n for node in nodes for n in rows(node)]
+        lowered = [self.lower(node) for node in nodes]
+        self.data[index:index + 1] = nodes
+        for (column, values) in zip((self.modes, self.opcodes, self.sizes,
+                                     self.operands, self.labels),
+                                    zip(*lowered)):
+            column[index:index + 1] = array.array(column.typecode, values)
+        if not lowered:
+            for column in (self.modes, self.opcodes, self.sizes,
+                           self.operands, self.labels):
+                del column[index]
+        return len(nodes)
+
+    def dependents(self):
+        """Returns a dictionary from each label to the indices of the
+        rows with expressions that refer to it, in order.  Rows that
+        refer to the program counter are listed under ^."""
+        if self.reverse is None:
+            self.reverse = {}
+            for (index, node) in enumerate(self.data):
+                labels = set()
+                for expr in node.data:
+                    if isinstance(expr, IR.Expr):
+                        (sublabels, pc) = expr.dependencies()
+                        labels.update(sublabels)
+                        if pc:
+                            labels.update(pc_label)
+                for label in labels:
+                    self.reverse.setdefault(label, []).append(index)
+        return self.reverse
+
+    def retype(self, index, mode):
+        "Gives row index a new address mode."
+        size = Ops.lengths[mode] + 1
+        if self.layout is not None:
+            self.layout.resize(index, size - self.sizes[index])
+        self.modes[index] = mode
+        self.sizes[index] = size
+        self.data[index].nodetype = nodetypes[mode]
+
+    def visit(self, index, asmpass, env):
+        """Visits row index as a node, re-lowering it if the pass
+        changed its node type, and returns the number of rows that
+        stand in its place afterwards."""
+        node = self.data[index]
+        node.accept(asmpass, env)
+        if modes.get(node.nodetype, OTHER) == self.modes[index] and \
+                node.nodetype != "SEQUENCE" and node.nodetype != "None":
+            return 1
+        return self.replace(index, [node])
+
+
+class Layout(object):
+    """Where the rows of an instruction table lie, as a label update
+    last found them, so that the next may look again at only what has
+    changed since.  Rows of mode OTHER may move the program counter
+    anywhere, so they are visited every time; the program counter after
+    each is kept in exits.  Between them, the program counter is found
+    from the sums of the rows' sizes.  The layout also keeps the label
+    rows that must be evaluated again, in dirty, and the rows whose
+    expressions may have changed value since instruction selection
+    last looked at them, in stale; a stale of None means all of them."""
+    __slots__ = ("sums", "anchors", "exits", "pc_rows", "dirty", "stale")
+
+    def __init__(self, table, exits):
+        self.sums = PrefixSums(table.sizes)
+        self.anchors = sorted(exits)
+        self.exits = exits
+        self.pc_rows = [row for row in table.dependents().get("^", ())
+                        if table.modes[row] == LABEL]
+        self.dirty = set()
+        self.stale = None
+
+    def shifted(self, row, rows=None):
+        """Returns those of the sorted list rows, by default the label
+        rows that use the program counter, from just after row to the
+        next row of mode OTHER."""
+        if rows is None:
+            rows = self.pc_rows
+        anchor = bisect.bisect_right(self.anchors, row)
+        if anchor < len(self.anchors):
+            end = bisect.bisect_left(rows, self.anchors[anchor])
+        else:
+            end = len(rows)
+        return rows[bisect.bisect_right(rows, row):end]
+
+    def resize(self, row, delta):
+        "Notes that a row has grown by delta bytes."
+        if delta != 0:
+            self.sums.add(row, delta)
+            self.dirty.update(self.shifted(row))
+
+
+class PrefixSums(object):
+    """The sums of the leading entries of an array of sizes, kept as a
+    Fenwick tree: finding a sum, or changing a size, takes time in
+    proportion to the logarithm of the array's length."""
+    __slots__ = ("tree",)
+
+    def __init__(self, sizes):
+        tree = array.array('l', [0])
+        tree.extend(sizes)
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self.tree = tree
+
+    def add(self, index, delta):
+        "Adds delta to the size at index."
+        tree = self.tree
+        index += 1
+        while index < len(tree):
+            tree[index] += delta
+            index += index & -index
+
+    def total(self, count):
+        "Returns the sum of the first count sizes."
+        tree = self.tree
+        result = 0
+        while count > 0:
+            result += tree[count]
+            count &= count - 1
+        return result
+
+
+def size(node, mode):
+    "Returns the size of a row of the given mode, if it has a fixed size."
+    if mode < MEMORY:
+        return Ops.lengths[mode] + 1
+    elif mode < BYTE:
+        return 3
+    elif mode in widths:
+        return widths[mode] * len(node.data)
+    elif mode == BLOB:
+        return len(node.data[0])
+    return 0
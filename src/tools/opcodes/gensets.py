@@ -16,6 +16,8 @@ prologue = '"""' + """Opcodes file.
 # This file was automatically generated by gensets.py based on the
 # the tables in tools/opcodes. Edit those tables, not these.
 
+import types
+
 # Names of addressing modes
 modes = ["Implied",
          "Immediate",
@@ -43,6 +45,35 @@ modes = ["Implied",
 # Lengths of the argument
 lengths = [0, 1, 2, 1, 1, 1, 2, 2, 2, 2, 2, 2, 2, 1, 1, 1, 1, 1, 1, 2, 2]
 """
+epilogue = """
+
+def _chipset(extensions):
+    table = dict((mnem, tuple(codes)) for (mnem, codes) in opcodes.items())
+    table.update((mnem, tuple(codes)) for (mnem, codes) in extensions.items())
+    return types.MappingProxyType(table)
+
+
+# Read-only instruction tables and mnemonic sets for each supported
+# chip, built once from the base instruction set and the chip's
+# extensions.  select() picks the ones an assembly uses; the tables
+# themselves are never changed.
+chipsets = {"6502": _chipset({}),
+            "6510": _chipset(undocops),
+            "65c02": _chipset(c02extensions),
+            "4502": _chipset(csg4502extensions)}
+mnemonic_sets = dict((chip, frozenset(table))
+                     for (chip, table) in chipsets.items())
+
+
+def select(chip):
+    "Makes the named chip's instruction set current."
+    global opcodes, mnemonics
+    opcodes = chipsets[chip]
+    mnemonics = mnemonic_sets[chip]
+
+
+select("6502")"""
+
 
 # These values should match the ones in the prologue string.
 modes = ["Implied",
@@ -183,3 +214,4 @@ if __name__ == '__main__':
         print("%s = {" % field)
         dump_map(instruction_map, ' ' * (len(field) + 4))
         print("%s}" % (' ' * (len(field) + 3)))
+    print(epilogue)
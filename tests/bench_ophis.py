@@ -0,0 +1,769 @@
+#!/usr/bin/env python3
+
+# Performance benchmarks for the Ophis assembler. Unlike test_ophis.py,
+# these import Ophis directly so that individual stages can be timed
+# without process startup costs drowning out the numbers. Each
+# benchmark compares the current code against an older implementation,
+# reproduced here as a reference, through the shared harness below.
+
+import sys
+import copy
+import os
+import os.path
+import time
+import tracemalloc
+
+homepath = os.path.realpath(os.path.dirname(sys.argv[0]))
+sys.path.insert(0, os.path.join(homepath, "..", "src"))
+
+import Ophis.CmdLine as Cmd
+import Ophis.Environment
+import Ophis.Errors as Err
+import Ophis.Frontend as FE
+import Ophis.IR as IR
+import Ophis.Passes
+import Ophis.Table
+
+
+def timed(f, *args):
+    "Returns the wall-clock time taken by a call to f."
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+
+def retained_memory(f, *args):
+    "Returns the number of bytes still allocated by a call to f."
+    tracemalloc.start()
+    try:
+        result = f(*args)
+        return tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def arguments(implementation, setup):
+    """Builds the arguments for one call of an implementation, outside
+    the timed region."""
+    if setup is None:
+        return ()
+    arg = setup()
+    if len(implementation) > 2:
+        arg = implementation[2](arg)
+    return (arg,)
+
+
+def agree(reference, current, setup, key):
+    """Runs reference and current once each, untimed, and reports
+    whether their results match."""
+    old = reference[1](*arguments(reference, setup))
+    new = current[1](*arguments(current, setup))
+    if key(old) != key(new):
+        print("MISMATCH")
+        return False
+    return True
+
+
+def run_benchmark(title, reference, current, setup=None, runs=5,
+                  key=lambda x: x, count=None, unit=None):
+    """Times two implementations of the same work against each other.
+
+    reference and current are (label, function) pairs.  If setup is
+    given, each call is passed a fresh result of setup(), built outside
+    the timed region; a third element in either pair converts that
+    result for its function, also untimed.  The results of both
+    functions, passed through key, must match before anything is
+    timed.  The two are run alternately, so that both see the same
+    background noise, and the best time of each is reported; with a
+    count, as a rate in units per second."""
+    print("\n==== %s ====" % title)
+    if not agree(reference, current, setup, key):
+        return
+    best = [None, None]
+    for i in range(runs):
+        for (j, implementation) in enumerate([reference, current]):
+            args = arguments(implementation, setup)
+            elapsed = timed(implementation[1], *args)
+            if best[j] is None or elapsed < best[j]:
+                best[j] = elapsed
+    width = max(len(reference[0]), len(current[0]), len("Speedup")) + 2
+    for (label, elapsed) in zip([reference[0], current[0]], best):
+        if count is None:
+            print("%-*s%10.3f s" % (width, label + ":", elapsed))
+        else:
+            print("%-*s%10.0f %s/sec" % (width, label + ":",
+                                         count / elapsed, unit))
+    print("%-*s%10.2fx" % (width, "Speedup:", best[0] / best[1]))
+
+
+def run_memory_benchmark(title, reference, current, count, unit,
+                         setup=None):
+    """Measures the memory held by the results of two implementations
+    of the same work, called as by run_benchmark on a single result
+    of setup(), and reports it in bytes per unit."""
+    print("\n==== %s ====" % title)
+    args = () if setup is None else (setup(),)
+    width = max(len(reference[0]), len(current[0])) + 2
+    for (label, f) in [reference, current]:
+        size = retained_memory(f, *args)
+        print("%-*s%10.1f bytes/%s" % (width, label + ":", size / count,
+                                       unit))
+
+
+def synthetic_source(lines):
+    "Builds a list of source lines resembling generated ROM data."
+    templates = ['    .byte $%02X, $%02X, %d, %d, $%02X, $%02X, %d, %d',
+                 '    lda table+%d, x   ; fetch entry %d',
+                 '    sta $%04X\n    .word lbl_%d, lbl_%d+%d',
+                 'lbl_%d: .byte "Line %d of generated text", 0',
+                 '    bne -\n    jmp (vector_%d)   ; %d']
+    result = []
+    i = 0
+    while len(result) < lines:
+        t = templates[i % len(templates)]
+        text = t % tuple((i * 7 + j) & 0xFF for j in range(t.count('%')))
+        result.extend(text.split('\n'))
+        i += 1
+    return result[:lines]
+
+
+def program(source):
+    "Parses a list of source lines into a fresh tree."
+    Err.count = 0
+    return IR.SequenceNode("bench.oph", list(
+        FE.iter_nodes("bench.oph", source)))
+
+
+# The tokens, token stream, and character-at-a-time lexer Ophis used
+# through version 2.3, kept as a baseline for the lexer and parser
+# benchmarks.
+
+class ReferenceLexeme(object):
+    def __init__(self, type="UNKNOWN", value=None):
+        self.type = type.upper()
+        self.value = value
+
+    def __str__(self):
+        if self.value is None:
+            return self.type
+        else:
+            return self.type + ":" + str(self.value)
+
+
+class ReferenceParseLine(object):
+    def __init__(self, lexemes):
+        self.lexemes = lexemes
+        self.location = 0
+
+    def lookahead(self, i):
+        target = self.location + i
+        if target >= len(self.lexemes):
+            target = -1
+        return self.lexemes[target]
+
+    def pop(self):
+        old = self.location
+        if self.location < len(self.lexemes) - 1:
+            self.location += 1
+        return self.lexemes[old]
+
+    def expect(self, *tokens):
+        token = self.pop()
+        if token.type in tokens:
+            return token
+        if 'LABEL' in tokens:
+            if token.type in ['X', 'Y', 'Z', 'SP']:
+                token.value = token.type.lower()
+                token.type = 'LABEL'
+                return token
+            elif token.type == 'OPCODE':
+                token.type = 'LABEL'
+                return token
+        Err.log('Expected: "' + '", "'.join(tokens) + '"')
+        return token
+
+
+def reference_lex(point, line):
+    Err.currentpoint = point
+    result = []
+
+    def add_token(token):
+        if token == "":
+            return
+        if token == "0":
+            result.append(ReferenceLexeme("NUM", 0))
+            return
+        firstchar = token[0]
+        rest = token[1:]
+        if firstchar == '"':
+            result.append(ReferenceLexeme("STRING", rest))
+            return
+        elif firstchar in FE.bases:
+            try:
+                result.append(ReferenceLexeme("NUM",
+                                        int(rest, FE.bases[firstchar][1])))
+                return
+            except ValueError:
+                Err.log('Invalid ' + FE.bases[firstchar][0] +
+                        ' constant: ' + rest)
+                result.append(ReferenceLexeme("NUM", 0))
+                return
+        elif firstchar.isdigit():
+            try:
+                result.append(ReferenceLexeme("NUM", int(token)))
+            except ValueError:
+                Err.log('Identifiers may not begin with a number')
+                result.append(ReferenceLexeme("LABEL", "ERROR"))
+            return
+        elif firstchar == "'":
+            if len(rest) == 1:
+                result.append(ReferenceLexeme("NUM", ord(rest)))
+            else:
+                Err.log("Invalid character constant '" + rest + "'")
+                result.append(ReferenceLexeme("NUM", 0))
+            return
+        elif firstchar in FE.punctuation:
+            result.append(ReferenceLexeme(firstchar))
+            return
+        else:
+            id = token.lower()
+            if id in FE.Ops.opcodes:
+                result.append(ReferenceLexeme("OPCODE", id))
+            elif id in ["x", "y", "z", "sp"]:
+                result.append(ReferenceLexeme(id))
+            else:
+                result.append(ReferenceLexeme("LABEL", id))
+            return
+
+    value = ""
+    quotemode = False
+    backslashmode = False
+    for c in line.strip():
+        if backslashmode:
+            backslashmode = False
+            value = value + c
+        elif c == "\\":
+            backslashmode = True
+        elif quotemode:
+            if c == '"':
+                quotemode = False
+            else:
+                value = value + c
+        elif c == ';':
+            add_token(value)
+            value = ""
+            break
+        elif c == '.' and value != "":
+            value = value + c
+        elif c.isspace():
+            add_token(value)
+            value = ""
+        elif c in FE.punctuation:
+            add_token(value)
+            add_token(c)
+            value = ""
+        elif c == '"':
+            add_token(value)
+            value = '"'
+            quotemode = True
+        else:
+            value = value + c
+    if backslashmode:
+        Err.log("Backslashed newline")
+    if quotemode:
+        Err.log("Unterminated string constant")
+    add_token(value)
+    result.append(ReferenceLexeme("EOL"))
+    return result
+
+
+def bench_lexer():
+    source = synthetic_source(50000)
+    lines = [("bench.oph:%d" % (i + 1), line)
+             for (i, line) in enumerate(source)]
+
+    def lex_all(lexer):
+        return lambda: [lexer(ppt, line) for (ppt, line) in lines]
+
+    def tokens(result):
+        return [[str(x) for x in lexemes] for lexemes in result]
+
+    run_benchmark("LEXER THROUGHPUT",
+                  ("Reference lexer", lex_all(reference_lex)),
+                  ("Current lexer", lex_all(FE.lex)),
+                  key=tokens, count=len(lines), unit="lines")
+    run_memory_benchmark("LEXER MEMORY",
+                         ("Reference tokens", lex_all(reference_lex)),
+                         ("Current tokens", lex_all(FE.lex)),
+                         len(lines), "line")
+
+
+# The closure-based expression parser Ophis used through version 2.3.
+
+def reference_parse_expr(line, first_atom=None):
+
+    def atom():
+        "Parses lowest-priority expression components."
+        next = line.lookahead(0).type
+        if next == "NUM":
+            return IR.ConstantExpr(line.expect("NUM").value)
+        elif next in ["LABEL", "X", "Y", "Z", "SP", "OPCODE"]:
+            return IR.LabelExpr(line.expect("LABEL").value)
+        elif next == "^":
+            line.expect("^")
+            return IR.PCExpr()
+        elif next == "{":
+            line.expect("{")
+            result = reference_parse_expr(line)
+            line.expect("}")
+            return result
+        elif next == "[":
+            line.expect("[")
+            result = reference_parse_expr(line)
+            line.expect("]")
+            return result
+        elif next == "(":
+            line.expect("(")
+            result = reference_parse_expr(line)
+            line.expect(")")
+            return result
+        elif next == "+":
+            offset = 0
+            while next == "+":
+                offset += 1
+                line.expect("+")
+                next = line.lookahead(0).type
+            return IR.LabelExpr("*" + str(FE.templabelcount + offset))
+        elif next == "-":
+            offset = 1
+            while next == "-":
+                offset -= 1
+                line.expect("-")
+                next = line.lookahead(0).type
+            return IR.LabelExpr("*" + str(FE.templabelcount + offset))
+        elif next == ">":
+            line.expect(">")
+            return IR.HighByteExpr(atom())
+        elif next == "<":
+            line.expect("<")
+            return IR.LowByteExpr(atom())
+        else:
+            Err.log('Expected: expression')
+
+    def precedence_read(constructor, reader, separators, head=None):
+        """Handles precedence.  The reader argument is a function that returns
+    expressions that bind more tightly than these; separators is a list
+    of strings naming the operators at this precedence level.  The
+    constructor argument is a class, indicating what node type holds
+    objects of this precedence level. The optional head argument, if not
+    None, indicates that a parse discovered this was an expression partway
+    through and must now complete the tail.
+
+    Returns a list of Expr objects with separator strings between them."""
+        if head is not None:
+            result = [head] # preassign first object
+        else:
+            result = [reader()]  # read first object
+        nextop = line.lookahead(0).type
+        while (nextop in separators):
+            line.expect(nextop)
+            result.append(nextop)
+            result.append(reader())
+            nextop = line.lookahead(0).type
+        if len(result) == 1:
+            return result[0]
+        return constructor(result)
+
+    def term(h=None):
+        "Parses * and /"
+        return precedence_read(IR.SequenceExpr, atom, ["*", "/"], h)
+
+    def arith(h=None):
+        "Parses + and -"
+        return precedence_read(IR.SequenceExpr, term, ["+", "-"], h)
+
+    def bits(h=None):
+        "Parses &, |, and ^"
+        return precedence_read(IR.SequenceExpr, arith, ["&", "|", "^"], h)
+
+    if first_atom is None:
+        return bits()
+    first_term = term(first_atom)
+    first_arith = arith(first_term)
+    return bits(first_arith)
+
+
+def bench_expressions():
+    source = ['    lda #<(table_%d + %d * 2)' % (i, i & 0x3F)
+              for i in range(2000)]
+    source += ['    .word (base + %d) & $FF00 | {offset - %d} / 4, %d' %
+               (i, i, i) for i in range(2000)]
+    source += ['    sta $%04X, x' % i for i in range(2000)]
+    # Each line is lexed both ways, and parsing skips the opcode and
+    # any immediate-mode marker.
+    lexed = []
+    for (i, line) in enumerate(source):
+        ppt = "bench.oph:%d" % (i + 1)
+        tokens = FE.lex(ppt, line)
+        start = 2 if tokens[1].kind == FE.HASH else 1
+        lexed.append((reference_lex(ppt, line), tokens, start))
+
+    def parse_all(which, parse_line, parse_expr):
+        def run():
+            result = []
+            for entry in lexed:
+                line = parse_line(entry[which])
+                line.location = entry[2]
+                result.append(parse_expr(line))
+            return result
+        return run
+
+    run_benchmark("EXPRESSION PARSING",
+                  ("Reference parser",
+                   parse_all(0, ReferenceParseLine, reference_parse_expr)),
+                  ("Current parser",
+                   parse_all(1, FE.ParseLine, FE.parse_expr)),
+                  key=lambda exprs: [str(x) for x in exprs],
+                  count=len(lexed), unit="expressions")
+
+
+reference_classes = {}
+
+
+def reference_ir(x):
+    "Copies IR x into instances of unslotted classes with the same fields."
+    if isinstance(x, list):
+        return [reference_ir(y) for y in x]
+    if not isinstance(x, (IR.Node, IR.Expr)):
+        return x
+    cls = type(x)
+    if cls not in reference_classes:
+        reference_classes[cls] = type("Reference" + cls.__name__,
+                                      (object,), {})
+    result = reference_classes[cls]()
+    for klass in cls.__mro__:
+        for field in getattr(klass, "__slots__", ()):
+            if hasattr(x, field):
+                setattr(result, field, reference_ir(getattr(x, field)))
+    return result
+
+
+def count_ir(x):
+    "Counts the nodes and expressions in IR x."
+    if isinstance(x, list):
+        return sum(count_ir(y) for y in x)
+    if isinstance(x, IR.Node):
+        return 1 + count_ir(x.data)
+    if isinstance(x, IR.SequenceExpr):
+        return 1 + count_ir(x.data)
+    if isinstance(x, (IR.HighByteExpr, IR.LowByteExpr)):
+        return 1 + count_ir(x.data)
+    if isinstance(x, IR.Expr):
+        return 1
+    return 0
+
+
+def bench_ir_memory():
+    ir = list(FE.iter_nodes("bench.oph", synthetic_source(50000)))
+    # Both copies share the strings and numbers in the original, so
+    # only the objects themselves are measured.
+    run_memory_benchmark("IR MEMORY",
+                         ("Unslotted IR", reference_ir),
+                         ("Current IR", copy.deepcopy),
+                         count_ir(ir), "object", setup=lambda: ir)
+
+
+# Expressions as Ophis evaluated them through version 2.3: by walking
+# the tree on every call.
+
+class InterpretedSequenceExpr(IR.SequenceExpr):
+    __slots__ = ()
+
+    def value(self, env=None):
+        subs = list(map((lambda x: x.value(env)), self.operands))
+        result = subs[0]
+        index = 1
+        for op in self.operators:
+            result = self.operate(result, op, subs[index])
+            index += 1
+        return result
+
+
+class InterpretedHighByteExpr(IR.HighByteExpr):
+    __slots__ = ()
+
+    def value(self, env=None):
+        return (self.data.value(env) >> 8) & 0xff
+
+
+class InterpretedLowByteExpr(IR.LowByteExpr):
+    __slots__ = ()
+
+    def value(self, env=None):
+        return self.data.value(env) & 0xff
+
+
+class InterpretedLabelExpr(IR.LabelExpr):
+    __slots__ = ()
+
+    def value(self, env=None):
+        return env[self.data]
+
+
+def interpreted(x):
+    "Rebuilds the expressions in IR x out of the classes above."
+    if isinstance(x, IR.Node):
+        x.data = [interpreted(y) for y in x.data]
+    elif isinstance(x, IR.SequenceExpr):
+        return InterpretedSequenceExpr([interpreted(y) for y in x.data])
+    elif isinstance(x, IR.HighByteExpr):
+        return InterpretedHighByteExpr(interpreted(x.data))
+    elif isinstance(x, IR.LowByteExpr):
+        return InterpretedLowByteExpr(interpreted(x.data))
+    elif isinstance(x, IR.LabelExpr):
+        return InterpretedLabelExpr(x.data)
+    return x
+
+
+def assemble_labels(tree):
+    "Runs the label and instruction selection passes of a full assembly."
+    Err.count = 0
+    env = Ophis.Environment.Environment()
+    i = Ophis.Passes.InitLabels()
+    l = Ophis.Passes.UpdateLabels()
+    c = Ophis.Passes.Collapse()
+    a = Ophis.Passes.Assembler()
+    passes = [Ophis.Passes.FixPoint("label initialization", [i],
+                                    lambda: not i.changed),
+              Ophis.Passes.FixPoint("instruction selection", [l, c],
+                                    lambda: not c.changed),
+              Ophis.Passes.NormalizeModes(), l, a]
+    for p in passes:
+        p.go(tree, env)
+    return bytes(a.output)
+
+
+def bench_evaluation():
+    # Forward references to labels that move as earlier instructions
+    # collapse to zero page keep the fixpoints busy.
+    source = ['.org $80']
+    for i in range(3000):
+        source.append('l%d: lda l%d + %d * 2 - [l%d & $0F] + '
+                      '[l%d - l%d] / 4, x' %
+                      (i, i + 1, i & 7, i + 2, i + 2, i))
+        source.append('    .word >[l%d - l%d] | [^ - l%d / 2] & <[l%d + 3]' %
+                      (i, i + 1, i, i + 2))
+    source.append('l3000: l3001: rts')
+    # Parsing is not timed; each run gets a tree built beforehand.
+    run_benchmark("EXPRESSION EVALUATION",
+                  ("Interpreted expressions", assemble_labels, interpreted),
+                  ("Compiled expressions", assemble_labels),
+                  setup=lambda: program(source), runs=3)
+
+
+def getattr_accept(self, asmpass, env=None):
+    "Node.accept as it was before passes had dispatch tables."
+    Err.currentpoint = self.ppt
+    routine = getattr(asmpass, "visit" + self.nodetype,
+                      asmpass.visitUnknown)
+    routine(self, env)
+
+
+def run_passes(tree):
+    "Runs a dozen passes that do little more than visit every node."
+    Err.count = 0
+    env = Ophis.Environment.Environment()
+    for i in range(2):
+        for p in [Ophis.Passes.InitLabels(), Ophis.Passes.CircularityCheck(),
+                  Ophis.Passes.EasyModes(), Ophis.Passes.UpdateLabels(),
+                  Ophis.Passes.Collapse(), Ophis.Passes.NormalizeModes()]:
+            p.go(tree, env)
+
+
+def with_getattr_accept(f, *args):
+    "Calls f with Node.accept replaced by getattr_accept."
+    accept = IR.Node.accept
+    IR.Node.accept = getattr_accept
+    try:
+        f(*args)
+    finally:
+        IR.Node.accept = accept
+
+
+def bench_dispatch():
+    source = ['.org $0800']
+    for i in range(10000):
+        source.append('l%d: lda #%d' % (i, i & 0xFF))
+        source.append('    sta $%04X, x' % (0x2000 + i))
+        source.append('    .byte %d' % (i & 0xFF))
+    run_benchmark("VISITOR DISPATCH",
+                  ("getattr per node",
+                   lambda tree: with_getattr_accept(run_passes, tree)),
+                  ("Dispatch tables", run_passes),
+                  setup=lambda: program(source), runs=3)
+
+
+class FullUpdateLabels(Ophis.Passes.UpdateLabels):
+    "A label update that lays the whole table out afresh each time."
+
+    def visitTable(self, node, env):
+        node.layout = None
+        Ophis.Passes.UpdateLabels.visitTable(self, node, env)
+
+
+def select_incrementally(tree, update):
+    """Runs instruction selection and assembly over tree, lowered to an
+    instruction table, with the given label update pass."""
+    Err.count = 0
+    env = Ophis.Environment.Environment()
+    i = Ophis.Passes.InitLabels()
+    Ophis.Passes.FixPoint("label initialization", [i],
+                          lambda: not i.changed).go(tree, env)
+    Ophis.Passes.EasyModes().go(tree, env)
+    tree = Ophis.Table.InstructionTable(tree)
+    l = update()
+    c = Ophis.Passes.Collapse()
+    a = Ophis.Passes.Assembler()
+    passes = [Ophis.Passes.FixPoint("instruction selection", [l, c],
+                                    lambda: not c.changed),
+              Ophis.Passes.NormalizeModes(), l, a]
+    for p in passes:
+        p.go(tree, env)
+    return bytes(a.output)
+
+
+def bench_layout():
+    # Each zero page variable is the size of the block before it, less
+    # a constant, and fits in the zero page only once that block has
+    # collapsed, so the blocks collapse one fixpoint iteration at a time
+    # and each moves only the labels after it.
+    source = ['.org $0800', '.alias v0 $10']
+    for i in range(60):
+        source.append('s%d:' % i)
+        for j in range(100):
+            source.append('l%d_%d: lda v%d, x' % (i, j, i))
+            source.append('    sta $%04X' % (0x2000 + j))
+        source.append('e%d:' % i)
+        source.append('.alias v%d [e%d-s%d]-$130' % (i + 1, i, i))
+    run_benchmark("INCREMENTAL LAYOUT",
+                  ("Full layout", lambda tree: select_incrementally(
+                      tree, FullUpdateLabels)),
+                  ("Incremental layout", lambda tree: select_incrementally(
+                      tree, Ophis.Passes.UpdateLabels)),
+                  setup=lambda: program(source), runs=3)
+
+
+class WalkExtendBranches(Ophis.Passes.ExtendBranches):
+    "A branch extension that walks the whole table each time."
+
+    def visitTable(self, node, env):
+        self.walk(node, env)
+
+
+def extend_branches(tree, extend):
+    """Runs instruction selection, with the given branch extension
+    pass, and assembly over tree, lowered to an instruction table."""
+    Err.count = 0
+    env = Ophis.Environment.Environment()
+    i = Ophis.Passes.InitLabels()
+    Ophis.Passes.FixPoint("label initialization", [i],
+                          lambda: not i.changed).go(tree, env)
+    Ophis.Passes.EasyModes().go(tree, env)
+    tree = Ophis.Table.InstructionTable(tree)
+    l_basic = Ophis.Passes.UpdateLabels()
+    l = Ophis.Passes.FixPoint("label update", [l_basic],
+                              lambda: not l_basic.changed)
+    c_basic = Ophis.Passes.Collapse()
+    c = Ophis.Passes.FixPoint("instruction selection 1", [l, c_basic],
+                              lambda: not c_basic.changed)
+    b = extend()
+    a = Ophis.Passes.Assembler()
+    passes = [Ophis.Passes.FixPoint("instruction selection 2", [c, b],
+                                    lambda: not b.changed),
+              Ophis.Passes.NormalizeModes(), Ophis.Passes.UpdateLabels(), a]
+    for p in passes:
+        p.go(tree, env)
+    return bytes(a.output)
+
+
+def bench_branches():
+    # Each branch reaches just past the next, so that extending one
+    # puts the one before it out of range.  The last is out of range
+    # from the start, and the extensions ripple back one at a time.
+    source = ['.org $0800']
+    for i in range(90):
+        source.append('    beq e%d' % i)
+        source += ['    lda $%04X' % (0x2000 + j) for j in range(20)]
+        source += ['    nop', '    nop']
+        if i > 0:
+            source.append('e%d:' % (i - 1))
+    source.append('    .byte %s' % ", ".join(["0"] * 120))
+    source.append('e89:')
+    settings = Cmd.snapshot()
+    Cmd.parse_args(["-q", "--no-warn", "-"])
+    try:
+        run_benchmark("BRANCH EXTENSION",
+                      ("Whole table walks", lambda tree: extend_branches(
+                          tree, WalkExtendBranches)),
+                      ("Branch worklist", lambda tree: extend_branches(
+                          tree, Ophis.Passes.ExtendBranches)),
+                      setup=lambda: program(source), runs=3)
+    finally:
+        Cmd.restore(settings)
+
+
+def validation_passes():
+    "Returns fresh instances of the passes that validate a program."
+    return [Ophis.Passes.CircularityCheck(), Ophis.Passes.CheckExprs(),
+            Ophis.Passes.EasyModes()]
+
+
+def initialized(tree):
+    """Runs label initialization over tree, and returns it with its
+    environment."""
+    Err.count = 0
+    env = Ophis.Environment.Environment()
+    i = Ophis.Passes.InitLabels()
+    Ophis.Passes.FixPoint("label initialization", [i],
+                          lambda: not i.changed).go(tree, env)
+    return (tree, env)
+
+
+def validate(program, passes):
+    """Runs the given passes over an initialized program, and returns
+    the node types that result."""
+    (tree, env) = program
+    for p in passes:
+        p.go(tree, env)
+    return [node.nodetype for node in tree.data]
+
+
+def bench_validation():
+    source = ['.org $0800']
+    for i in range(10000):
+        source += ['l%d: ldx #0' % i, '    inx',
+                   '    lda v%d, x' % (i % 16), '    tay', '    iny',
+                   '    sty $2000', '    clc', '    bne l%d' % i]
+    source.append('.data')
+    source.append('.org $10')
+    source += ['.space v%d 1' % i for i in range(16)]
+    run_benchmark("FUSED VALIDATION",
+                  ("Separate passes", lambda prog: validate(
+                      prog, validation_passes())),
+                  ("Composite pass", lambda prog: validate(
+                      prog, [Ophis.Passes.Composite(
+                          "validation", validation_passes())])),
+                  setup=lambda: initialized(IR.flatten(program(source))))
+
+
+if __name__ == '__main__':
+    print("Using Python interpreter:", sys.executable)
+    Cmd.parse_args(["-q", "-"])
+    bench_lexer()
+    bench_expressions()
+    bench_ir_memory()
+    bench_evaluation()
+    bench_dispatch()
+    bench_layout()
+    bench_branches()
+    bench_validation()
@@ -0,0 +1,12 @@
+"""Extension pragmas for the test suite
+
+    Overrides .byte, so that tests can tell whose handler ran."""
+
+import Ophis.IR as IR
+import Ophis.CorePragmas
+
+
+def pragmaByte(ppt, line, result):
+    "Reads a .byte line as usual, but emits a single $42"
+    Ophis.CorePragmas.readData(line)
+    result.append(IR.Node(ppt, "Byte", IR.ConstantExpr(0x42)))
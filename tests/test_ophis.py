@@ -4,6 +4,8 @@ import sys
 import subprocess
 import os
 import os.path
+import shutil
+import tempfile
 
 if len(sys.argv) > 1:
     pythonpath = sys.argv[1]
@@ -11,6 +13,7 @@ else:
     pythonpath = sys.executable
 homepath = os.path.realpath(os.path.dirname(sys.argv[0]))
 ophispath = os.path.join(homepath, "..", "bin", "ophis")
+srcpath = os.path.join(homepath, "..", "src")
 
 failed = 0
 
@@ -48,6 +51,62 @@ def test_string(test_name, asm, expected, options=[]):
         print("Error output:\n%s" % err.decode(sys.stderr.encoding))
 
 
+def test_error(test_name, asm, message, options=[]):
+    "Checks that assembling asm fails, reporting message."
+    (out, err) = assemble_string(asm, options)
+    err = err.decode(sys.stderr.encoding)
+    if out == b'' and message in err:
+        print("%s: SUCCESS" % test_name)
+    else:
+        global failed
+        failed += 1
+        print("%s: FAILED" % test_name)
+        print("Assembled code: ", assembled(out))
+        print("Expected error: ", message)
+        print("Error output:\n%s" % err)
+
+
+# Some tests need several runs of the assembler within one process, or
+# an extension module. These run a script that drives Ophis directly;
+# each call to assemble() in it writes that run's output to stdout.
+
+script_prelude = """
+import os
+import tempfile
+import Ophis.Main
+import Ophis.Frontend
+
+
+def assemble(asm, options=[]):
+    with tempfile.NamedTemporaryFile("w", suffix=".oph", dir=".",
+                                     delete=False) as f:
+        f.write(asm)
+    try:
+        Ophis.Main.run_ophis(["-qo", "-", f.name] + options)
+    finally:
+        os.unlink(f.name)
+"""
+
+
+def test_script(test_name, script, expected):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([srcpath, homepath])
+    p = subprocess.Popen([pythonpath, "-c", script_prelude + script],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         env=env)
+    (out, err) = p.communicate()
+    if out == expected:
+        print("%s: SUCCESS" % test_name)
+    else:
+        global failed
+        failed += 1
+        print("%s: FAILED" % test_name)
+        print("Assembled code: ", assembled(out))
+        print("Expected code:  ", assembled(expected))
+    if err != b'':
+        print("Error output:\n%s" % err.decode(sys.stderr.encoding))
+
+
 def test_file(test_name, fname, ename, options=[]):
     f = open(os.path.join(homepath, fname), 'rt')
     asm = f.read()
@@ -84,6 +143,9 @@ def test_basic():
         test_file('65c02 extensions', 'test65c02.oph', 'test65c02.bin', ['-c'])
         test_file('4502 extensions', 'test4502.oph', 'test4502.bin', ['-4'])
         test_file('Wide instructions', 'testwide.oph', 'testwide.bin', ['-c'])
+        test_script('Chip selection does not outlast its run',
+                    'assemble("stz $10", ["-c"])\n'
+                    'assemble("stz $10")\n', b'\x64\x10')
         test_file('Branch restrictions (6502)', 'longbranch.oph', None,
                   ['--no-branch-extend'])
         test_file('Branch restrictions (65c02)', 'branch_c02.oph', None,
@@ -209,6 +271,20 @@ def test_outfile():
         print("Multiple input files: FAILED (exception)")
         failed += 1
 
+    # Test 7: multiple input files parsed in parallel
+    try:
+        out = assemble_raw('', ['-o', '-', '-u', '-j', '2',
+                                os.path.join(homepath, "testbase.oph"),
+                                os.path.join(homepath, "test6510.oph")])[0]
+        if out != s:
+            print("Parallel input files: FAILED (bad output)")
+            failed += 1
+        else:
+            print("Parallel input files: SUCCESS")
+    except:
+        print("Parallel input files: FAILED (exception)")
+        failed += 1
+
 
 def test_transforms():
     print("\n==== BINARY TRANSFORM PASSES ====")
@@ -217,6 +293,12 @@ def test_transforms():
                 b'\xa5\xfe\xa5\xfc\x60')
     test_string('Reversible collapse', '.org $fb \n bne ^+200 \n lda ^ \n',
                 b'\xf0\x03\x4c\xc5\x01\xad\x00\x01')
+    # The first branch is in range until the second is extended.
+    body = " nop\n" * 124 + "t1: nop\n" + " nop\n" * 200 + "t2: rts\n"
+    (expected, err) = assemble_string('.org $1000\n bne +\n jmp t1\n'
+                                      '* beq +\n jmp t2\n*\n' + body)
+    test_string('Cascading branch extension',
+                '.org $1000\n beq t1\n bne t2\n' + body, expected)
 
 
 def test_expressions():
@@ -228,13 +310,25 @@ def test_expressions():
     test_string('Basic bit-union', '.byte 5|9', b'\x0d')
     test_string('Basic bit-intersection', '.byte 5&9', b'\x01')
     test_string('Basic bit-toggle', '.byte 5^9', b'\x0c')
+    test_string('Number bases', ".byte $41, %01000010, 0103, 68, 'E",
+                b'ABCDE')
     test_string('Division truncation', '.byte 5/2', b'\x02')
     test_string('Overflow', '.byte $FF*$10', b'')
     test_string('Multibyte overflow', '.word $FF*$10', b'\xf0\x0f')
+    test_error('Overflow of folded constant',
+               '.alias z0 $C0\n.byte [z0*2]+1',
+               'Byte constant [[z0 * 2] + 1] out of range')
+    test_error('Overflow of folded alias', '.alias hi 300\n.byte hi',
+               'Byte constant hi out of range')
+    test_error('Overflow of partly folded expression',
+               '.alias k 2\nl: .byte l+0+k*150',
+               'Byte constant [l + 0 + [k * 150]] out of range')
     test_string('Masked overflow', '.byte $FF*$10&$FF', b'\xf0')
     test_string('Underflow', '.byte 2-3', b'')
     test_string('Masked underflow', '.byte 2-3&$FF', b'\xff')
     test_string('Arithmetic precedence', '.byte 2+3*4-6/2', b'\x0b')
+    test_string('Left associativity', '.byte 20-5-3, 64/4/2, 2-3+4',
+                b'\x0c\x08\x03')
     test_string('Parentheses', '.byte (2+3)*(4-6/2)', b'\x05')
     test_string('Brackets', '.byte [2+3]*[4-6/2]', b'\x05')
     test_string('Braces', '.byte {2+3}*{4-6/2}', b'\x05')
@@ -247,13 +341,29 @@ def test_expressions():
     test_string('String escapes',
                 '.byte "The man said, \\"The \\\\ is Windowsy.\\""',
                 b'The man said, "The \\ is Windowsy."')
+    test_string('Comment characters in strings',
+                '.byte "a;b" ; "a comment"', b'a;b')
+    test_string('Escapes outside strings',
+                '.byte \'\\;, \'\\ , "x"', b'; x')
     test_string('Byte selector precedence',
                 '.byte >$d000+32,>[$d000+32],<[$D000-275]',
                 b'\xf0\xd0\xed')
+    test_string('Expressions of one shape',
+                '.org $10\nl1: .byte l1+3, l2+3, l1*2, l2&l1\nl2:',
+                b'\x13\x17\x20\x10')
     test_string('Named labels', '.org $6948\nl: .word l', b'Hi')
     test_string('.alias directive (basic)', '.alias hi $6948\n.word hi', b'Hi')
     test_string('.alias directive (derived)',
                 '.alias hi $6948\n.alias ho hi+$600\n.word hi,ho', b'HiHo')
+    test_string('.alias directive (used before defined)',
+                '.alias ho hi+$600\nlda ho\nlda <ho\n.alias hi $0048',
+                b'\xad\x48\x06\xa5\x48')
+    test_string('.alias directive (scoped)',
+                '.alias _z $10\n.scope\n.alias _z $1000\nlda _z\n.scend\n'
+                'lda _z',
+                b'\xad\x00\x10\xa5\x10')
+    test_string('Identity operations',
+                '.org $10\nl: lda l+0*1-0,x\n.word ^/1|0^0', b'\xb5\x10\x12\x00')
     test_string('.alias directive (circular)',
                 '.alias a c+1\n.alias b a+3\n.alias c b-4\n.word a, b, c',
                 b'')
@@ -276,6 +386,120 @@ def test_expressions():
     test_string('Opcodes usable as labels',
                 'ldy #$00\n dey: dey\n bne dey',
                 b'\xa0\x00\x88\xd0\xfd')
+    test_script("Constants are interned",
+                'import pickle\n'
+                'import sys\n'
+                'import Ophis.IR as IR\n'
+                'five = IR.ConstantExpr(5)\n'
+                'big = IR.ConstantExpr(0x10000)\n'
+                'copy = pickle.loads(pickle.dumps([five, big]))\n'
+                'sys.stdout.write("%s %s %s" % (IR.ConstantExpr(5) is five,\n'
+                '                               copy[0] is five,\n'
+                '                               copy[1].data))\n',
+                b'True True 65536')
+    test_script("Operands that decide their own validity",
+                'import sys\n'
+                'import Ophis.IR as IR\n'
+                'import Ophis.Environment\n'
+                'class Flagged(IR.Expr):\n'
+                '    def valid(self, env=None, PCvalid=False):\n'
+                '        return env is not None and "flag" in env\n'
+                'class Always(IR.LabelExpr):\n'
+                '    def valid(self, env=None, PCvalid=False):\n'
+                '        return True\n'
+                'env = Ophis.Environment.Environment()\n'
+                'high = IR.HighByteExpr(Flagged(0))\n'
+                'seq = IR.SequenceExpr([IR.LowByteExpr(Flagged(0)), "+",\n'
+                '                       IR.LabelExpr("a")])\n'
+                'always = IR.SequenceExpr([Always("b"), "-", IR.PCExpr()])\n'
+                'before = [high.valid(env), seq.valid(env),\n'
+                '          always.valid(env, True)]\n'
+                'env["flag"] = env["a"] = 1\n'
+                'after = [high.valid(env), seq.valid(env),\n'
+                '         always.valid(env, False)]\n'
+                'sys.stdout.write("%s %s" % (before, after))\n',
+                b'[False, False, True] [True, True, False]')
+
+
+def test_pragmas():
+    print("\n==== EXTENSION PRAGMAS ====")
+    test_script("Extension overrides .byte",
+                'import extpragmas\n'
+                'Ophis.Frontend.register_pragmas(extpragmas)\n'
+                'assemble(".byte 1\\n.word 1")\n', b'\x42\x01\x00')
+
+
+def test_passes():
+    print("\n==== EXTENSION PASSES ====")
+    test_script("Pass without Pass.__init__",
+                'import sys\n'
+                'import Ophis.IR as IR\n'
+                'import Ophis.Environment\n'
+                'import Ophis.Passes\n'
+                'class CountBytes(Ophis.Passes.Pass):\n'
+                '    def __init__(self):\n'
+                '        self.count = 0\n'
+                '    def visitByte(self, node, env):\n'
+                '        self.count += len(node.data)\n'
+                '    def visitUnknown(self, node, env):\n'
+                '        pass\n'
+                'one = IR.ConstantExpr(1)\n'
+                'program = IR.SequenceNode("p",\n'
+                '                          [IR.Node("p", "Byte", one, one),\n'
+                '                           IR.Node("p", "Word", one)])\n'
+                'p = CountBytes()\n'
+                'p.go(program, Ophis.Environment.Environment())\n'
+                'sys.stdout.write(str(p.count))\n', b'2')
+    test_script("Errors are not held after a failed pass",
+                'import sys\n'
+                'import Ophis.IR as IR\n'
+                'import Ophis.Environment\n'
+                'import Ophis.Errors as Err\n'
+                'import Ophis.Passes\n'
+                'class Broken(Ophis.Passes.Pass):\n'
+                '    def visitUnknown(self, node, env):\n'
+                '        raise ValueError\n'
+                'program = IR.SequenceNode("p", [IR.Node("p", "Byte")])\n'
+                'p = Ophis.Passes.Composite("broken", [Broken()])\n'
+                'try:\n'
+                '    p.go(program, Ophis.Environment.Environment())\n'
+                'except ValueError:\n'
+                '    pass\n'
+                'Err.log("logged")\n'
+                'sys.stdout.write(str(Err.count))\n', b'1')
+    test_profile()
+
+
+def test_profile():
+    global failed
+    (out, err) = assemble_string('.byte 1', ['--profile-passes'])
+    lines = err.decode(sys.stderr.encoding).splitlines()
+    names = [line.split(None, 5)[5] for line in lines[2:]]
+    expected = ["Parsing", "Label Update Pass", "Label Update Pass (2)",
+                "label update", "validation", "Assembler"]
+    if out == b'\x01' and lines[:1] == ["Pass profile:"] and \
+            all(names.count(name) == 1 for name in expected):
+        print("Pass profile: SUCCESS")
+    else:
+        failed += 1
+        print("Pass profile: FAILED")
+        print("Assembled code: ", assembled(out))
+        print("Profile:\n%s" % "\n".join(lines))
+    # The last label update only revisits the rows that may have
+    # moved, and is profiled with that count, not the table's length.
+    (out, err) = assemble_string('.org $800\n' + 'nop\n' * 50 +
+                                 'l: .byte <l\n', ['--profile-passes'])
+    lines = err.decode(sys.stderr.encoding).splitlines()
+    nodes = dict((line.split(None, 5)[5], line.split(None, 5)[4])
+                 for line in lines[2:])
+    if out == b'\xea' * 50 + b'\x32' and \
+            int(nodes["Label Update Pass (2)"]) < int(nodes["Assembler"]):
+        print("Pass profile (incremental rows): SUCCESS")
+    else:
+        failed += 1
+        print("Pass profile (incremental rows): FAILED")
+        print("Assembled code: ", assembled(out))
+        print("Profile:\n%s" % "\n".join(lines))
 
 
 def test_segments():
@@ -288,6 +512,10 @@ def test_segments():
                 '.text\n'
                 'l: .byte l, d', b'Aa')
     test_string('Data cleanliness', '.byte 65\n.data\n.byte 65', b'')
+    test_string('Data cleanliness (strings)', '.byte "A"\n.data\n.byte "A"',
+                b'')
+    test_string('Data cleanliness (.incbin)',
+                '.byte 65\n.data\n.incbin "baseinc.bin"', b'')
     test_string('.space directive',
                 '.data\n.org $41\n.space a 2\n.space b 1\n.space c 1\n'
                 '.text\n.byte a, b, c\n', b'ACD')
@@ -377,9 +605,28 @@ def test_macros():
                 '  `inner\n'
                 '.macend\n'
                 "`greet", b"")
+    test_error('Errors within nested macros',
+               '.macro inner\n'
+               '  .byte 300\n'
+               '.macend\n'
+               '.macro greet\n'
+               '  `inner\n'
+               '.macend\n'
+               "`greet", '-:7->-:5->-:2: Byte constant 300 out of range')
+    test_script('Macro expansions share program points',
+                'import sys\n'
+                'import Ophis.IR as IR\n'
+                'body = IR.ProgramPoint("m.oph", 2)\n'
+                'inner = IR.ProgramPoint("m.oph", 5)\n'
+                'call = IR.ProgramPoint("p.oph", 7)\n'
+                'first = body.called_from(inner.called_from(call))\n'
+                'again = body.called_from(inner.called_from(call))\n'
+                'sys.stdout.write("%s %s" % (first, first is again))\n',
+                b'p.oph:7->m.oph:5->m.oph:2 True')
 
 
 def test_subfiles():
+    global failed
     print("\n==== COMPILATION UNITS ====")
     test_string(".include pragma", '.include "baseinc.oph"', b'BASIC\n')
     test_string(".include repeated",
@@ -398,6 +645,91 @@ def test_subfiles():
     test_string(".require different files with identical paths",
                 '.include "sub/sub/sub.oph"',
                 b'SUB 2 START\nSUB 1 START\nBASIC\nSUB 1 END\nSUB 2 END\n')
+    cachedir = tempfile.mkdtemp()
+    try:
+        for run in ["cold", "warm"]:
+            test_string(".include with parse cache (%s)" % run,
+                        '.include "sub/sub/sub.oph"\n'
+                        '.include "baseinc.oph"',
+                        b'SUB 2 START\nSUB 1 START\nBASIC\nSUB 1 END\n'
+                        b'SUB 2 END\nBASIC\n',
+                        ['--parse-cache-dir', cachedir])
+        test_script(".include with parse cache (new pragma module)",
+                    'options = ["--parse-cache-dir", %r]\n'
+                    'assemble(\'.include "baseinc.oph"\', options)\n'
+                    'import extpragmas\n'
+                    'Ophis.Frontend.register_pragmas(extpragmas)\n'
+                    'assemble(\'.include "baseinc.oph"\', options)\n'
+                    % cachedir, b'BASIC\nB')
+    finally:
+        shutil.rmtree(cachedir)
+    cachedir = tempfile.mkdtemp()
+    srcdir = tempfile.mkdtemp()
+    try:
+        options = ['--parse-cache-dir', cachedir]
+        outer = os.path.join(srcdir, "outer.oph").replace("\\", "/")
+        inner = os.path.join(srcdir, "inner.oph").replace("\\", "/")
+        late = os.path.join(srcdir, "late.oph").replace("\\", "/")
+        with open(outer, "w") as f:
+            f.write('.include "inner.oph"\n.require "inner.oph"\n')
+        with open(late, "w") as f:
+            f.write('.byte 9\n.require "inner.oph"\n')
+        with open(inner, "w") as f:
+            f.write('.byte 1\n')
+        test_string(".include with parse cache (includer)",
+                    '.include "%s"' % outer, b'\x01', options)
+        if len(os.listdir(cachedir)) != 2:
+            failed += 1
+            print(".include with parse cache (includer cached): FAILED")
+            print("Cache entries:", os.listdir(cachedir))
+        with open(inner, "w") as f:
+            f.write('.byte 2\n')
+        test_string(".include with parse cache (included file changed)",
+                    '.include "%s"' % outer, b'\x02', options)
+        test_string(".include with parse cache (.require skipped)",
+                    '.require "%s"\n.include "%s"' % (inner, late),
+                    b'\x02\x09', options)
+        test_string(".include with parse cache (.require not skipped)",
+                    '.include "%s"' % late, b'\x09\x02', options)
+    finally:
+        shutil.rmtree(cachedir)
+        shutil.rmtree(srcdir)
+    test_string(".include (search path)", '.include "sub.oph"',
+                b'SUB 2 START\nSUB 1 START\nBASIC\nSUB 1 END\nSUB 2 END\n',
+                ['-I', 'sub', '-I', 'sub/sub'])
+    test_string(".include (local file before search path)",
+                '.include "baseinc.oph"', b'BASIC\n', ['-I', 'sub'])
+    test_string(".include (not on search path)", '.include "sub.oph"', b'',
+                ['-I', 'sub'])
+    test_string(".require via search path and directly",
+                '.require "sub/sub/sub.oph"\n.require "sub.oph"',
+                b'SUB 2 START\nSUB 1 START\nBASIC\nSUB 1 END\nSUB 2 END\n',
+                ['-I', 'sub/sub'])
+    srcdir = tempfile.mkdtemp()
+    try:
+        mixed = os.path.join(srcdir, "mixed.oph")
+        with open(mixed, "wb") as f:
+            f.write(b'.byte 1\r\n.byte 2\r.byte 3\n\r\n.byte 4')
+        empty = os.path.join(srcdir, "empty.oph")
+        open(empty, "wb").close()
+        test_string(".include (mixed line endings)",
+                    '.include "%s"' % mixed.replace("\\", "/"),
+                    b'\x01\x02\x03\x04')
+        test_string(".include (empty file)",
+                    '.include "%s"\n.byte 5' % empty.replace("\\", "/"),
+                    b'\x05')
+    finally:
+        shutil.rmtree(srcdir)
+    test_script("Source lines are decoded before they are split",
+                'import sys\n'
+                'import Ophis.Files as Files\n'
+                'Files.chunk_size = 3\n'
+                'text = "one\\r\\ntw\\u010d\\rthree\\n\\r\\nfour"\n'
+                'for encoding in ["utf-8", "utf-16-le"]:\n'
+                '    found = list(Files.lines(text.encode(encoding),\n'
+                '                             encoding))\n'
+                '    sys.stdout.write(ascii(found) + "\\n")\n',
+                b"['one', 'tw\\u010d', 'three', '', 'four']\n" * 2)
     test_string(".charmap (basic)",
                 '.charmap \'A, "abcdefghijklmnopqrstuvwxyz"\n'
                 '.charmap \'a, "ABCDEFGHIJKLMNOPQRSTUVWXYZ"\n'
@@ -419,6 +751,9 @@ def test_subfiles():
     test_string(".charmapbin (basic)",
                 '.charmapbin "../examples/petscii.map"\n.byte "hELLO, wORLD!"',
                 b"Hello, World!")
+    test_string(".charmapbin (search path)",
+                '.charmapbin "petscii.map"\n.byte "hELLO, wORLD!"',
+                b"Hello, World!", ['-I', '../examples'])
     test_string(".charmapbin (illegal)",
                 '.charmapbin "baseinc.bin"\n.byte "hELLO, wORLD!"', b'')
     test_string(".incbin (basic)", '.incbin "baseinc.bin"', b"BASIC\n")
@@ -455,6 +790,8 @@ def test_systematic():
     test_outfile()
     test_transforms()
     test_expressions()
+    test_pragmas()
+    test_passes()
     test_segments()
     test_scopes()
     test_macros()
@@ -464,12 +801,19 @@ def test_systematic():
 if __name__ == '__main__':
     print("Using Python interpreter:", pythonpath)
 
-    test_basic()
-    os.chdir(os.path.dirname(os.path.realpath(sys.argv[0])))
-    if failed == 0:
-        test_systematic()
-    else:
-        print("\nBasic test cases failed, aborting test.")
+    # The assembler caches what it parses by default; keep the cache
+    # these runs fill out of the user's own.
+    cachehome = tempfile.mkdtemp()
+    os.environ["XDG_CACHE_HOME"] = cachehome
+    try:
+        test_basic()
+        os.chdir(os.path.dirname(os.path.realpath(sys.argv[0])))
+        if failed == 0:
+            test_systematic()
+        else:
+            print("\nBasic test cases failed, aborting test.")
+    finally:
+        shutil.rmtree(cachehome)
 
     if failed > 0:
         print("\nTotal test case failures: %d" % failed)